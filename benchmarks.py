@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import random
+import time
+
+from types import SimpleNamespace
+
+import aiohttp
+import asyncpg
+import discord
+
+from aiohttp import web
+
+import utils
+from utils.checks import check_not_restricted
+from utils.metrics import Timings
+
+
+async def in_batches(calls, size=10):
+    """Awaits the coroutines size at a time, so later ones see the effects of earlier ones
+
+    Ten at a time is about what a busy bot has going at once"""
+    calls = list(calls)
+    for start in range(0, len(calls), size):
+        await asyncio.gather(*calls[start : start + size])
+
+
+# Command -> (median, spread) of a lognormal latency in seconds, roughly what the bot sees
+_latencies = {
+    "help": (0.05, 0.3),
+    "tag": (0.08, 0.5),
+    "avatar": (0.4, 0.6),
+    "urban": (0.6, 0.7),
+    "osu": (1.8, 0.4),
+    "overwatch": (2.5, 0.5),
+}
+
+
+class _TypingContext:
+    def __init__(self, counts):
+        self.counts = counts
+
+    async def trigger_typing(self):
+        self.counts["typing"] += 1
+
+
+async def typing(args):
+    """Typing requests made when always typing, and when only typing for slow commands"""
+    # Time is sped up by scale, so this doesn't take as long as the commands would
+    amount, scale = args.commands, args.scale
+    threshold = utils.config.typing_threshold
+    rng = random.Random(0)
+    names = list(_latencies)
+    # Mostly quick commands, with the occasional slow lookup
+    weights = [40, 25, 15, 10, 6, 4]
+    runs = [
+        (name, rng.lognormvariate(0, _latencies[name][1]) * _latencies[name][0])
+        for name in rng.choices(names, weights, k=amount)
+    ]
+
+    async def old(ctx, name, latency, _):
+        # Typing was always started before the command ran
+        await ctx.trigger_typing()
+        await asyncio.sleep(latency / scale)
+
+    async def new(ctx, name, latency, timings):
+        task = asyncio.ensure_future(
+            utils.delayed_typing(
+                ctx, utils.typing_delay(name, timings) / scale, timings
+            )
+        )
+        await asyncio.sleep(latency / scale)
+        task.cancel()
+        timings.observe("total", latency, command=name)
+
+    for label, run in (("Always typing", old), ("Delayed typing", new)):
+        counts = {"typing": 0}
+        ctx = _TypingContext(counts)
+        timings = Timings()
+        await in_batches(run(ctx, name, latency, timings) for name, latency in runs)
+        slow = sum(1 for _, latency in runs if latency > threshold)
+        print(
+            f"{label}: {counts['typing']} typing requests for {amount} commands "
+            f"({slow} took longer than {threshold}s)"
+        )
+
+
+async def _old_check_not_restricted(ctx):
+    """How restrictions were checked before they were indexed"""
+    if type(ctx.message.channel) is discord.DMChannel:
+        return True
+
+    restrictions = ctx.bot.cache.restrictions[ctx.guild.id]
+    for from_restriction in restrictions.get("from", []):
+        source = from_restriction.get("source")
+        destination = from_restriction.get("destination")
+        if destination == "everyone" and ctx.command.qualified_name == source:
+            return False
+        if source != ctx.command.qualified_name:
+            continue
+
+        destination = int(destination)
+        if destination == ctx.channel.id:
+            return False
+        elif discord.utils.get(ctx.author.roles, id=destination):
+            return False
+        elif destination == ctx.author.id:
+            return False
+
+    to_restrictions = restrictions.get("to", [])
+    if not to_restrictions:
+        return True
+
+    whitelisted_role = False
+    whitelisted_channel = False
+    whitelist_found = False
+    for to_restriction in to_restrictions:
+        source = to_restriction.get("source")
+        destination = int(to_restriction.get("destination"))
+        if source != ctx.command.qualified_name:
+            continue
+
+        whitelist_found = True
+        if not whitelisted_role and discord.utils.get(ctx.author.roles, id=destination):
+            whitelisted_role = True
+        if ctx.channel.id == destination:
+            whitelisted_channel = True
+
+    return whitelisted_role or whitelisted_channel or not whitelist_found
+
+
+async def restrictions(args):
+    """Time per restriction check, scanning every restriction and using the index"""
+    rng = random.Random(0)
+    names = [f"command{i}" for i in range(100)]
+    channels = list(range(1000, 1050))
+    roles = list(range(2000, 2030))
+    members = list(range(3000, 3500))
+
+    for size in args.sizes:
+        cache = utils.Cache(None)
+        for _ in range(size):
+            from_to = rng.choice(("from", "to"))
+            pool = channels + roles + (members if from_to == "from" else [])
+            restriction = {
+                "source": rng.choice(names),
+                "destination": str(rng.choice(pool)),
+            }
+            cache.restrictions[1].setdefault(from_to, []).append(restriction)
+            cache._index_restriction(1, from_to, restriction)
+
+        bot = SimpleNamespace(cache=cache)
+        guild = SimpleNamespace(id=1)
+        contexts = []
+        for _ in range(args.checks):
+            channel = SimpleNamespace(id=rng.choice(channels))
+            author = SimpleNamespace(
+                id=rng.choice(members),
+                roles=[SimpleNamespace(id=r) for r in rng.sample(roles, 5)],
+            )
+            contexts.append(
+                SimpleNamespace(
+                    bot=bot,
+                    guild=guild,
+                    channel=channel,
+                    author=author,
+                    message=SimpleNamespace(channel=channel),
+                    command=SimpleNamespace(qualified_name=rng.choice(names)),
+                )
+            )
+
+        async def run(check):
+            results = []
+            start = time.perf_counter()
+            for ctx in contexts:
+                results.append(await check(ctx))
+            return time.perf_counter() - start, results
+
+        old, old_results = await run(_old_check_not_restricted)
+        new, new_results = await run(check_not_restricted)
+        # They're only comparable if they came to the same decisions
+        assert old_results == new_results
+        print(
+            f"{size} restrictions: old {old / args.checks * 1000000:.1f}us, "
+            f"new {new / args.checks * 1000000:.1f}us per check"
+        )
+
+
+class _CountingConnection(asyncpg.Connection):
+    """Counts every statement sent to the server, each one being a round trip
+
+    BEGIN, COMMIT and the reset when a connection goes back to the pool all go through execute"""
+
+    round_trips = 0
+
+    async def execute(self, *args, **kwargs):
+        _CountingConnection.round_trips += 1
+        return await super().execute(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        _CountingConnection.round_trips += 1
+        return await super().fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        _CountingConnection.round_trips += 1
+        return await super().fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        _CountingConnection.round_trips += 1
+        return await super().fetchval(*args, **kwargs)
+
+
+async def database(args):
+    """Round trips and latency of commands making their queries each in a transaction, on their own, or in a session"""
+    db = utils.DB()
+    db.opts = {"dsn": args.dsn} if args.dsn else dict(utils.config.db_opts)
+    db.opts["connection_class"] = _CountingConnection
+    db.replicas = []
+    await db.connect()
+    query = "SELECT $1::int AS number"
+
+    async def transaction_per_query(number):
+        # How every query used to be made
+        for _ in range(args.queries):
+            await db.fetchrow(query, number, transaction=True)
+
+    async def per_query(number):
+        for _ in range(args.queries):
+            await db.fetchrow(query, number)
+
+    async def session(number):
+        session = db.session()
+        try:
+            for _ in range(args.queries):
+                await db.fetchrow(query, number)
+        finally:
+            await session.close()
+
+    async def timed(run, number, latencies):
+        start = time.perf_counter()
+        await run(number)
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        # So every connection has the statement prepared before anything is measured
+        await asyncio.gather(*(per_query(n) for n in range(db.controller.max_size)))
+        approaches = (
+            ("Transaction per query", transaction_per_query),
+            ("Per query", per_query),
+            ("Session", session),
+        )
+        for name, run in approaches:
+            latencies = []
+            _CountingConnection.round_trips = 0
+            await in_batches(timed(run, n, latencies) for n in range(args.commands))
+            latencies.sort()
+            print(
+                f"{name}: {_CountingConnection.round_trips / args.commands:.1f} round trips per command, "
+                f"{sum(latencies) / args.commands * 1000:.2f}ms mean, "
+                f"{latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms p95"
+            )
+    finally:
+        db.close()
+        await db._pool.close()
+
+
+async def http(args):
+    """Connections opened making requests to a local server with a new session per request, and with the shared one"""
+    connections = set()
+
+    async def handler(request):
+        # Holding on to the transports themselves, as the ids of closed ones get reused
+        connections.add(request.transport)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = "http://127.0.0.1:{}/".format(site._server.sockets[0].getsockname()[1])
+
+    async def per_request():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                await response.read()
+
+    client = utils.HTTPClient()
+
+    async def shared():
+        async with client.session.get(url) as response:
+            await response.read()
+
+    try:
+        approaches = (("New session per request", per_request), ("Shared", shared))
+        for name, call in approaches:
+            connections.clear()
+            start = time.perf_counter()
+            await in_batches(call() for _ in range(args.calls))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name}: {len(connections)} connections opened for {args.calls} requests, "
+                f"{elapsed / args.calls * 1000:.2f}ms per request"
+            )
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the old and current way of doing things that were sped up"
+    )
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_typing = benchmarks.add_parser("typing", help=typing.__doc__)
+    parser_typing.add_argument("--commands", type=int, default=1000)
+    parser_typing.add_argument(
+        "--scale", type=float, default=100, help="How many times faster than real time"
+    )
+    parser_typing.set_defaults(run=typing)
+
+    parser_restrictions = benchmarks.add_parser(
+        "restrictions", help=restrictions.__doc__
+    )
+    parser_restrictions.add_argument("--checks", type=int, default=10000)
+    parser_restrictions.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser_restrictions.set_defaults(run=restrictions)
+
+    parser_database = benchmarks.add_parser("database", help=database.__doc__)
+    parser_database.add_argument(
+        "--dsn", help="The database to run against, defaults to the one in the config"
+    )
+    parser_database.add_argument("--commands", type=int, default=1000)
+    parser_database.add_argument(
+        "--queries", type=int, default=3, help="How many queries each command makes"
+    )
+    parser_database.set_defaults(run=database)
+
+    parser_http = benchmarks.add_parser("http", help=http.__doc__)
+    parser_http.add_argument("--calls", type=int, default=1000)
+    parser_http.set_defaults(run=http)
+
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(args.run(args))
@@ -1,8 +1,11 @@
+import argparse
 import discord
 import logging
 import pendulum
 import aiohttp
 import asyncio
+import importlib
+import time
 
 from discord.ext import commands
 import utils
@@ -21,33 +24,128 @@ opts = {
     "chunk_guilds_at_startup": False,
 }
 
-bot = commands.AutoShardedBot(**opts)
-logging.basicConfig(level=logging.INFO, filename="bonfire.log")
+# When ran by launcher.py, this process is one cluster and only runs its range of shards
+parser = argparse.ArgumentParser()
+parser.add_argument("--cluster-id", type=int, default=None)
+parser.add_argument("--shard-ids", default=None)
+parser.add_argument("--shard-count", type=int, default=None)
+parser.add_argument("--supervisor-port", type=int, default=None)
+args, _ = parser.parse_known_args()
+if args.shard_ids is not None:
+    opts["shard_ids"] = [int(s) for s in args.shard_ids.split(",")]
+    opts["shard_count"] = args.shard_count
+
+
+class Context(commands.Context):
+    # The task that will start typing if this command takes too long
+    typing_task = None
+    # The database session this command's queries go through, if it uses utils.db_session
+    db_session = None
+
+    async def end_db_session(self, *, commit=True):
+        """Commits and releases this command's session, so it isn't held open while we talk to discord"""
+        if self.db_session is not None:
+            await self.db_session.close(commit=commit)
+
+    async def send(self, *args, **kwargs):
+        with utils.timings.timer("send"):
+            return await super().send(*args, **kwargs)
+
+
+class Bonfire(commands.AutoShardedBot):
+    async def get_context(self, message, *, cls=Context):
+        return await super().get_context(message, cls=cls)
+
+    async def invoke(self, ctx):
+        # If this is a placeholder for an extension that isn't loaded yet, load it then find the real command
+        if isinstance(ctx.command, (utils.LazyCommand, utils.LazyGroup)):
+            self.lazy.load(ctx.command.extension)
+            ctx = await self.get_context(ctx.message)
+        if ctx.command is not None:
+            self.lazy.touch(ctx.command)
+
+        # Anything timed while this command runs (checks, database, requests) will be recorded under it
+        if ctx.command is not None:
+            utils.timings.command.set(ctx.command.qualified_name)
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                utils.timings.observe(
+                    "total",
+                    time.perf_counter() - start,
+                    command=ctx.command.qualified_name,
+                )
+
+    async def close(self):
+        # Each is closed on its own, so one failing doesn't leave the rest open
+        # Usage goes first, to make sure anything still queued gets written before we go down
+        steps = (
+            ("command usage", self.usage.close),
+            ("analytics", self.analytics.close),
+            ("the chunker", self.chunker.stop),
+            ("the cluster client", self.cluster.stop),
+            ("the cache", self.cache.close),
+            ("the database", self.db.close),
+            ("the HTTP client", utils.http.close),
+            ("the connection to discord", super().close),
+        )
+        for name, step in steps:
+            try:
+                result = step()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as error:
+                logging.warning(
+                    "Failed to close {}: {}: {}".format(
+                        name, error.__class__.__name__, error
+                    )
+                )
+
+
+bot = Bonfire(**opts)
+logging.basicConfig(
+    level=logging.INFO,
+    filename="bonfire.log"
+    if args.cluster_id is None
+    else f"bonfire-{args.cluster_id}.log",
+)
 
 
 @bot.before_invoke
 async def before_invocation(ctx):
-    # Start typing
-    try:
-        await ctx.trigger_typing()
-    except (discord.Forbidden, discord.HTTPException):
-        pass
+    # If this is a subcommand, make sure timings go to it instead of the group
+    utils.timings.command.set(ctx.command.qualified_name)
+    # Once someone writes something, their reads skip the replicas for a while
+    bot.db.pin_key.set(ctx.author.id)
+
+    # Only show typing if this command is slow, either from what we've seen of it or once it's been running a while
+    ctx.typing_task = bot.loop.create_task(
+        utils.delayed_typing(ctx, utils.typing_delay(ctx.command.qualified_name))
+    )
+
+    options = getattr(ctx.command.callback, "db_session", None)
+    if options is not None:
+        ctx.db_session = bot.db.session(**options)
 
     # If this is a DM, or the guild has been chunked, we're done
     if not ctx.guild or ctx.guild.chunked:
         return
 
-    # Get a lock for the guild
-    lock = bot.chunked_guild_locks.get(ctx.guild.id)
-    # If one hasn't been created yet, create it
-    if lock is None:
-        lock = asyncio.Lock()
-        bot.chunked_guild_locks[ctx.guild.id] = lock
-    # Now only try to chunk when the lock is available
-    async with lock:
-        # Recheck if it's been chunked just in case, don't want to chunk if we don't have to
-        if ctx.guild and not ctx.guild.chunked:
-            await ctx.guild.chunk()
+    # Otherwise move this guild to the front of the queue, and wait (for a while) for it to be chunked
+    with utils.timings.timer("chunk"):
+        await bot.chunker.wait_for(ctx.guild, timeout=utils.chunk_wait_timeout)
+
+
+@bot.after_invoke
+async def after_invocation(ctx):
+    # If the command finished before we started typing, we never need to
+    if ctx.typing_task is not None:
+        ctx.typing_task.cancel()
+    # This runs even if the command raised, so the connection always goes back to the pool
+    if ctx.db_session is not None:
+        await ctx.db_session.close(commit=not ctx.command_failed)
 
 
 @bot.event
@@ -56,12 +154,8 @@ async def on_command_completion(ctx):
     guild = ctx.guild.id if ctx.guild else None
     command = ctx.command.qualified_name
 
-    await bot.db.execute(
-        "INSERT INTO command_usage(command, guild, author) VALUES ($1, $2, $3)",
-        command,
-        guild,
-        author,
-    )
+    bot.usage.record(command, guild, author)
+    bot.analytics.record(command, guild, author)
 
     # Now add credits to a users amount
     # user_credits = bot.db.load('credits', key=ctx.author.id, pluck='credits') or 1000
@@ -73,6 +167,36 @@ async def on_command_completion(ctx):
     # await bot.db.save('credits', update)
 
 
+# Anything that can change who's allowed to run what has to clear the cached can_run results
+@bot.event
+async def on_guild_role_update(before, after):
+    bot.cache.clear_decisions(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    bot.cache.clear_decisions(role.guild.id)
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.overwrites != after.overwrites:
+        bot.cache.clear_decisions(after.guild.id)
+
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles:
+        bot.cache.clear_decisions(after.guild.id)
+
+
+@bot.event
+async def on_guild_update(before, after):
+    # The owner can always run everything
+    if before.owner_id != after.owner_id:
+        bot.cache.clear_decisions(after.id)
+
+
 @bot.event
 async def on_command_error(ctx, error):
     error = error.original if hasattr(error, "original") else error
@@ -130,17 +254,67 @@ async def on_command_error(ctx, error):
         pass
 
 
+async def setup_database():
+    await bot.cache.setup()
+    # Pick up the analytics from before we restarted, then keep them saved
+    await bot.analytics.load()
+    bot.analytics.start()
+    # Only one process should be doing these, or the same rows would be counted more than once
+    if not bot.cluster.is_primary:
+        return
+
+    backfilled = False
+    while not bot.is_closed():
+        try:
+            await utils.create_partitions(bot.db)
+            # If this was interrupted or failed last time, it'll carry on from where it stopped
+            if not backfilled:
+                await utils.backfill_rollups(bot.db)
+                backfilled = True
+            # Expiring has to wait for the backfill, otherwise those rows would never be counted
+            await utils.expire_partitions(bot.db)
+        except Exception as error:
+            logging.warning(
+                "Failed to maintain command_usage partitions: {}: {}".format(
+                    error.__class__.__name__, error
+                )
+            )
+        # Until the backfill is done, try again soon rather than tomorrow
+        await asyncio.sleep(86400 if backfilled else 300)
+
+
 if __name__ == "__main__":
     bot.remove_command("help")
     # Setup our bot vars, db and cache
     bot.db = utils.DB()
     bot.cache = utils.Cache(bot.db)
+    bot.usage = utils.UsageRecorder(bot.db)
+    bot.analytics = utils.Analytics(bot.db, args.cluster_id)
+    bot.chunker = utils.ChunkScheduler(bot)
+    bot.cluster = utils.ClusterClient(bot, args.cluster_id, args.supervisor_port)
     bot.error_channel = utils.error_channel
-    # Start our startup task (cache sets up the database, so just this)
-    bot.loop.create_task(bot.cache.setup())
+    # Start our startup task (cache sets up the database, so everything else waits on it)
+    bot.loop.create_task(setup_database())
+    bot.usage.start()
+    bot.chunker.start()
+    bot.cluster.start()
+    if utils.metrics_port:
+        # Each cluster needs its own port
+        bot.loop.create_task(
+            utils.timings.serve(utils.metrics_port + (args.cluster_id or 0))
+        )
+    bot.lazy = utils.LazyExtensions(bot)
     for e in utils.extensions:
-        bot.load_extension(e)
+        # Lazy extensions only get placeholders for now
+        if bot.lazy.register(e):
+            continue
+        # Import first on its own, so that we can tell slow imports apart from slow cog setup
+        with utils.startup.timer(f"{e} import"):
+            importlib.import_module(e)
+        with utils.startup.timer(f"{e} setup"):
+            bot.load_extension(e)
+
+    bot.lazy.start()
 
     bot.uptime = pendulum.now(tz="UTC")
-    bot.chunked_guild_locks = {}
     bot.run(utils.bot_token)
@@ -37,6 +37,7 @@ class Admin(commands.Cog):
                 "from",
                 {"source": cmd.qualified_name, "destination": "everyone"},
             )
+            await ctx.bot.cache.notify("restrictions", ctx.guild.id)
 
     @commands.command()
     @commands.guild_only()
@@ -59,6 +60,7 @@ guild=$2
         ctx.bot.cache.remove_restriction(
             ctx.guild, "from", {"source": cmd.qualified_name, "destination": "everyone"}
         )
+        await ctx.bot.cache.notify("restrictions", ctx.guild.id)
         await ctx.send(f"{cmd.qualified_name} is no longer disabled")
 
     @commands.command()
@@ -98,6 +100,7 @@ guild=$2
         restrictions = await ctx.bot.db.fetch(
             "SELECT source, destination, from_to FROM restrictions WHERE guild=$1",
             ctx.guild.id,
+            replica_ok=True,
         )
 
         entries = []
@@ -336,6 +339,7 @@ guild=$2
                 ctx.bot.cache.add_restriction(
                     ctx.guild, from_to, {"source": source, "destination": destination}
                 )
+                await ctx.bot.cache.notify("restrictions", ctx.guild.id)
         elif overwrites:
             channel = overwrites.pop("channel")
             for target, setting in overwrites.items():
@@ -423,6 +427,7 @@ WHERE
             ctx.bot.cache.remove_restriction(
                 ctx.guild, arg2, {"source": source, "destination": destination}
             )
+            await ctx.bot.cache.notify("restrictions", ctx.guild.id)
 
         # If this isn't a blacklist/whitelist, then we are attempting to remove an overwrite
         else:
@@ -598,21 +603,17 @@ WHERE
                 await ctx.send("This command cannot have custom permissions setup!")
                 return
 
-        try:
-            await ctx.bot.db.execute(
-                "INSERT INTO custom_permissions (guild, command, permission) VALUES ($1, $2, $3)",
-                ctx.guild.id,
-                cmd.qualified_name,
-                perm_value,
-            )
-        except UniqueViolationError:
-            await ctx.bot.db.execute(
-                "UPDATE custom_permissions SET permission = $1 WHERE guild = $2 AND command = $3",
-                perm_value,
-                ctx.guild.id,
-                cmd.qualified_name,
-            )
+        await ctx.bot.db.upsert(
+            "custom_permissions",
+            {
+                "guild": ctx.guild.id,
+                "command": cmd.qualified_name,
+                "permission": perm_value,
+            },
+            ["guild", "command"],
+        )
         ctx.bot.cache.update_custom_permission(ctx.guild, cmd, perm_value)
+        await ctx.bot.cache.notify("custom_permissions", ctx.guild.id)
 
         await ctx.send(
             "I have just added your custom permissions; "
@@ -645,6 +646,7 @@ WHERE
         )
 
         ctx.bot.cache.update_custom_permission(ctx.guild, cmd, None)
+        await ctx.bot.cache.notify("custom_permissions", ctx.guild.id)
 
         await ctx.send("I have just removed the custom permissions for {}!".format(cmd))
 
@@ -4,7 +4,6 @@ import re
 import calendar
 
 from discord.ext import commands, tasks
-from asyncpg import UniqueViolationError
 import utils
 
 
@@ -81,7 +80,9 @@ ORDER BY
     birthday
 """
 
-        return await self.bot.db.fetch(query, [m.id for m in server.members])
+        return await self.bot.db.fetch(
+            query, [m.id for m in server.members], replica_ok=True
+        )
 
     @tasks.loop(hours=24)
     async def notify_birthdays(self):
@@ -110,9 +111,9 @@ AND
             if not channel:
                 continue
 
-            # Make sure it's chunked
-            if not g.chunked:
-                await g.chunk()
+            # Give it a chance to be chunked, but don't hold up every other guild's announcements on it
+            # If it isn't yet, the members we do have still get theirs
+            await self.bot.chunker.wait_for(g, timeout=utils.chunk_wait_timeout)
 
             bds = await self.get_birthdays_for_server(g, today=True)
 
@@ -154,12 +155,12 @@ WHERE
 
         EXAMPLE: !birthdays
         RESULT: A printout of the birthdays from everyone on this server"""
-        if not ctx.guild.chunked:
-            await ctx.guild.chunk()
+        # This needs every member, so wait on the chunk however long it takes
+        await ctx.bot.chunker.wait_for(ctx.guild)
 
         if member:
             date = await ctx.bot.db.fetchrow(
-                "SELECT birthday FROM users WHERE id=$1", member.id
+                "SELECT birthday FROM users WHERE id=$1", member.id, replica_ok=True
             )
             if date is None or date["birthday"] is None:
                 await ctx.send(f"I do not have {member.display_name}'s birthday saved!")
@@ -217,14 +218,7 @@ WHERE
             return
 
         await ctx.send(f"I have just saved your birthday as {date}")
-        try:
-            await ctx.bot.db.execute(
-                "INSERT INTO users (id, birthday) VALUES ($1, $2)", ctx.author.id, date
-            )
-        except UniqueViolationError:
-            await ctx.bot.db.execute(
-                "UPDATE users SET birthday = $1 WHERE id = $2", date, ctx.author.id
-            )
+        await ctx.bot.db.upsert("users", {"id": ctx.author.id, "birthday": date}, ["id"])
 
     @birthday.command(name="remove")
     @utils.can_run(send_messages=True)
@@ -13,6 +13,10 @@ class Blackjack(commands.Cog):
         self.bot = bot
         self.games = {}
 
+    def in_use(self):
+        """Whether there are games going on, which would be lost if this was unloaded"""
+        return bool(self.games)
+
     def cog_unload(self):
         # Simply cancel every task
         for game in self.games.values():
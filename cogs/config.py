@@ -1,5 +1,4 @@
 from discord.ext import commands
-from asyncpg import UniqueViolationError
 
 import utils
 
@@ -41,18 +40,15 @@ class GuildConfiguration(commands.Cog):
         return await converter.convert(ctx, setting)
 
     async def _set_db_guild_opt(self, opt, setting, ctx):
+        result = await ctx.bot.db.upsert(
+            "guilds", {"id": ctx.guild.id, opt: setting}, ["id"]
+        )
         if opt == "prefix":
+            await ctx.bot.cache.notify("prefixes", ctx.guild.id)
+            # Only start using the new prefix once it's been committed, a rollback would leave us using one that wasn't
+            await ctx.end_db_session()
             ctx.bot.cache.update_prefix(ctx.guild, setting)
-        try:
-            return await ctx.bot.db.execute(
-                f'INSERT INTO guilds (id, "{opt}") VALUES ($1, $2)',
-                ctx.guild.id,
-                setting,
-            )
-        except UniqueViolationError:
-            return await ctx.bot.db.execute(
-                f"UPDATE guilds SET {opt} = $1 WHERE id = $2", setting, ctx.guild.id
-            )
+        return result
 
     async def _show_bool_options(self, ctx, opt):
         result = await ctx.bot.db.fetchrow(
@@ -340,6 +336,8 @@ class GuildConfiguration(commands.Cog):
         return await self._set_db_guild_opt("raffle_alerts", channel.id, ctx)
 
     async def _handle_set_followed_picarto_channels(self, ctx, setting):
+        # Picarto can take a while to answer, don't hold a transaction (and a connection) open waiting on it
+        await ctx.end_db_session()
         user = await utils.request(f"http://api.picarto.tv/v1/channel/name/{setting}")
         if user is None:
             raise WrongSettingType(
@@ -369,8 +367,9 @@ WHERE
     id=$2 AND
     NOT $1 = ANY(ignored_channels);
 """
-        ctx.bot.loop.create_task(ctx.bot.cache.load_ignored())
-        return await ctx.bot.db.execute(query, channel.id, ctx.guild.id)
+        result = await ctx.bot.db.execute(query, channel.id, ctx.guild.id)
+        await ctx.bot.cache.invalidate("ignored", ctx.guild.id)
+        return result
 
     async def _handle_set_ignored_members(self, ctx, setting):
         # We want to make it possible to have members that aren't in the server ignored
@@ -389,8 +388,9 @@ WHERE
     id=$2 AND
     NOT $1 = ANY(ignored_members);
 """
-        ctx.bot.loop.create_task(ctx.bot.cache.load_ignored())
-        return await ctx.bot.db.execute(query, setting, ctx.guild.id)
+        result = await ctx.bot.db.execute(query, setting, ctx.guild.id)
+        await ctx.bot.cache.invalidate("ignored", ctx.guild.id)
+        return result
 
     async def _handle_set_rules(self, ctx, setting):
         query = """
@@ -548,7 +548,9 @@ SET
 WHERE
     id=$2
 """
-        return await ctx.bot.db.execute(query, channel.id, ctx.guild.id)
+        result = await ctx.bot.db.execute(query, channel.id, ctx.guild.id)
+        await ctx.bot.cache.invalidate("ignored", ctx.guild.id)
+        return result
 
     async def _handle_remove_ignored_members(self, ctx, setting=None):
         if setting is None:
@@ -572,7 +574,9 @@ SET
 WHERE
     id=$2
 """
-        return await ctx.bot.db.execute(query, setting, ctx.guild.id)
+        result = await ctx.bot.db.execute(query, setting, ctx.guild.id)
+        await ctx.bot.cache.invalidate("ignored", ctx.guild.id)
+        return result
 
     async def _handle_remove_rules(self, ctx, setting=None):
         if setting is None or not setting.isdigit():
@@ -788,6 +792,7 @@ WHERE
     @config.command(name="set", aliases=["add"])
     @commands.guild_only()
     @utils.can_run(manage_guild=True)
+    @utils.db_session(transaction=True)
     async def _set_setting(self, ctx, option, *, setting):
         """Sets one of the configuration settings for this server"""
         try:
@@ -798,15 +803,16 @@ WHERE
             )
         else:
             # First make sure there's an entry for this guild before doing anything
-            try:
-                await ctx.bot.db.execute(
-                    "INSERT INTO guilds(id) VALUES ($1)", ctx.guild.id
-                )
-            except UniqueViolationError:
-                pass
+            await ctx.bot.db.upsert("guilds", {"id": ctx.guild.id}, ["id"])
 
             try:
-                await coro(ctx, setting=setting)
+                try:
+                    await coro(ctx, setting=setting)
+                except BaseException:
+                    # Whatever the setting was, it wasn't set, so don't keep any of it
+                    await ctx.end_db_session(commit=False)
+                    raise
+                await ctx.end_db_session()
             except WrongSettingType as exc:
                 await ctx.send(exc.message)
             except MessageFormatError as exc:
@@ -1,8 +1,8 @@
-import aiohttp
 import logging
 import json
 import discord
 
+import utils
 from utils import config
 from discord.ext import commands
 
@@ -18,18 +18,17 @@ class StatsUpdate(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-
-    def cog_unload(self):
-        self.bot.loop.create_task(self.session.close())
 
     async def update(self):
-        server_count = len(self.bot.guilds)
+        # When clustered only one process needs to post, with the count across all of them
+        if not self.bot.cluster.is_primary:
+            return
+        server_count = self.bot.cluster.total("guilds")
 
         # Carbonitex request
         carbon_payload = {"key": config.carbon_key, "servercount": server_count}
 
-        async with self.session.post(carbonitex_url, data=carbon_payload) as resp:
+        async with utils.http.session.post(carbonitex_url, data=carbon_payload) as resp:
             log.info(
                 "Carbonitex statistics returned {} for {}".format(
                     resp.status, carbon_payload
@@ -45,7 +44,7 @@ class StatsUpdate(commands.Cog):
         }
 
         url = discord_bots_url.format(self.bot.user.id)
-        async with self.session.post(url, data=payload, headers=headers) as resp:
+        async with utils.http.session.post(url, data=payload, headers=headers) as resp:
             log.info(
                 "bots.discord.pw statistics returned {} for {}".format(
                     resp.status, payload
@@ -57,7 +56,7 @@ class StatsUpdate(commands.Cog):
         payload = {"server_count": server_count}
 
         headers = {"Authorization": config.discordbots_key}
-        async with self.session.post(url, data=payload, headers=headers) as resp:
+        async with utils.http.session.post(url, data=payload, headers=headers) as resp:
             log.info(
                 "discordbots.com statistics retruned {} for {}".format(
                     resp.status, payload
@@ -80,6 +80,10 @@ class Hangman(commands.Cog):
     games = {}
     pending_games = []
 
+    def in_use(self):
+        """Whether there are games going on, which would be lost if this was unloaded"""
+        return bool(self.games or self.pending_games)
+
     def create(self, word, ctx):
         # Create a new game, then save it as the server's game
         game = Game(word)
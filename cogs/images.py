@@ -12,7 +12,7 @@ class Images(commands.Cog):
     """Commands that post images, or look up images"""
 
     async def horse_noodle_api(self, ctx, animal):
-        data = await utils.request(f"http://hrsendl.com/api/{animal}")
+        data = await utils.request(f"http://hrsendl.com/api/{animal}", coalesce=False)
 
         try:
             url = data["data"]["file_url_size_large"]
@@ -35,7 +35,7 @@ class Images(commands.Cog):
         RESULT: A beautiful picture of a cat o3o"""
         url = "http://thecatapi.com/api/images/get"
         opts = {"format": "src"}
-        result = await utils.request(url, attr="url", payload=opts)
+        result = await utils.request(url, attr="url", payload=opts, coalesce=False)
 
         e = discord.Embed(title="Source", url=str(result))
         e.set_image(url=str(result))
@@ -48,7 +48,9 @@ class Images(commands.Cog):
 
         EXAMPLE: !doggo
         RESULT: A beautiful picture of a dog o3o"""
-        result = await utils.request("https://dog.ceo/api/breeds/image/random")
+        result = await utils.request(
+            "https://dog.ceo/api/breeds/image/random", coalesce=False
+        )
         try:
             url = result.get("message")
             e = discord.Embed(title="Source", url=str(url))
@@ -139,6 +141,9 @@ class Images(commands.Cog):
                     await ctx.send(file=f)
                 except discord.HTTPException:
                     await ctx.send("Sorry but that avatar is too large for me to send!")
+                finally:
+                    # It may have been spooled to disk, so make sure it's cleaned up even if sending failed
+                    filedata.close()
         else:
             await ctx.send(url)
 
@@ -217,7 +222,7 @@ class Images(commands.Cog):
             # .url will be the URL we end up at, not the one requested.
             # https://derpibooru.org/images/random redirects to a random image, so this is exactly what we want
             image_link = await utils.request(
-                "https://derpibooru.org/images/random", attr="url"
+                "https://derpibooru.org/images/random", attr="url", coalesce=False
             )
         await ctx.send(image_link)
 
@@ -253,7 +258,9 @@ class Images(commands.Cog):
         # Tack on a random order
         params["tags"] += " order:random"
 
-        data = await utils.request(url, payload=params, headers=headers)
+        data = await utils.request(
+            url, payload=params, headers=headers, coalesce=False
+        )
 
         if data is None:
             await ctx.send(
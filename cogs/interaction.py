@@ -228,6 +228,7 @@ class Interaction(commands.Cog):
     @commands.command()
     @commands.guild_only()
     @utils.can_run(send_messages=True)
+    @utils.db_session(transaction=True)
     async def accept(self, ctx):
         """Accepts the battle challenge
 
@@ -340,6 +341,7 @@ VALUES
             await ctx.bot.db.execute(insert_query, winner.id, winner_rating, 1, 0)
 
         results = await ctx.bot.db.fetch(query, member_list, [winner.id, loser.id])
+        await ctx.end_db_session()
 
         new_winner_rank = new_loser_rank = None
         for result in results:
@@ -388,6 +390,7 @@ VALUES
     @commands.guild_only()
     @commands.cooldown(1, 10, BucketType.user)
     @utils.can_run(send_messages=True)
+    @utils.db_session(transaction=True)
     async def boop(self, ctx, boopee: discord.Member = None, *, message=""):
         """Boops the mentioned person
 
@@ -422,11 +425,12 @@ VALUES
                 "UPDATE boops SET amount=$3 WHERE booper=$1 AND boopee=$2"
             )
             amount = amount["amount"] + 1
+        await ctx.bot.db.execute(replacement_query, booper.id, boopee.id, amount)
+        await ctx.end_db_session()
 
         await ctx.send(
             f"{booper.mention} has just booped {boopee.mention}{message}! That's {amount} times now!"
         )
-        await ctx.bot.db.execute(replacement_query, booper.id, boopee.id, amount)
 
 
 class Battle:
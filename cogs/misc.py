@@ -194,9 +194,9 @@ class Miscellaneous(commands.Cog):
         name = "User/Guild statistics"
         value = ""
 
-        value += "Channels: {}".format(len(list(ctx.bot.get_all_channels())))
-        value += "\nUsers: {}".format(len(ctx.bot.users))
-        value += "\nServers: {}".format(len(ctx.bot.guilds))
+        value += "Channels: {}".format(ctx.bot.cluster.total("channels"))
+        value += "\nUsers: {}".format(ctx.bot.cluster.total("users"))
+        value += "\nServers: {}".format(ctx.bot.cluster.total("guilds"))
         embed.add_field(name=name, value=value, inline=False)
 
         # The game statistics
@@ -7,8 +7,11 @@ import inspect
 import io
 import re
 import textwrap
+import time
 import traceback
 
+import utils
+
 
 def get_syntax_error(e):
     if e.text is None:
@@ -18,6 +21,12 @@ def get_syntax_error(e):
     )
 
 
+def code_block(output):
+    """Wraps output in a code block, cutting it short so the block still fits in one message"""
+    # 2000 is discord's limit, less the 7 characters the fences take
+    return f"```\n{output[:1993]}```"
+
+
 class Owner(commands.Cog):
     """Commands that can only be used by the owner of the bot, bot management commands"""
 
@@ -216,6 +225,157 @@ class Owner(commands.Cog):
         await ctx.bot.logout()
         await ctx.bot.close()
 
+    @commands.command()
+    async def usage(self, ctx):
+        """Shows how the command usage logging is keeping up"""
+        usage = ctx.bot.usage
+        await ctx.send(
+            f"Queued: {usage.queued}\n"
+            f"Flushed: {usage.flushed}\n"
+            f"Dropped: {usage.dropped}\n"
+            f"Pending: {usage.pending}"
+        )
+
+    @commands.command()
+    async def latency(self, ctx, amount: int = 10):
+        """Shows the slowest commands, and the slowest phases of running commands"""
+        timings = utils.timings
+
+        fmt = "{:<25} {:>8} {:>8} {:>8} {:>8}"
+        lines = [fmt.format("Command", "Count", "p50", "p95", "p99")]
+        for command, histogram in timings.slowest_commands(amount):
+            lines.append(
+                fmt.format(
+                    command[:25],
+                    histogram.count,
+                    *(f"{histogram.percentile(q) * 1000:.0f}ms" for q in timings.quantiles),
+                )
+            )
+
+        lines.append("")
+        lines.append(fmt.format("Phase", "Count", "p50", "p95", "p99"))
+        for phase, histogram in timings.slowest_phases(amount):
+            lines.append(
+                fmt.format(
+                    phase,
+                    histogram.count,
+                    *(f"{histogram.percentile(q) * 1000:.0f}ms" for q in timings.quantiles),
+                )
+            )
+
+        output = "\n".join(lines)
+        await ctx.send(code_block(output))
+
+    @commands.command()
+    async def queries(self, ctx, amount: int = 5, sort: str = "total"):
+        """Shows the worst query templates, sorted by total, mean, max, count, rows or wait"""
+        if sort not in utils.QueryStats.sort_keys:
+            await ctx.send(
+                "You can sort by: {}".format(", ".join(utils.QueryStats.sort_keys))
+            )
+            return
+
+        lines = []
+        for template, stats in utils.query_stats.slowest(amount, sort):
+            latency = stats.latency
+            lines.append(
+                f"{latency.count} calls, {latency.total * 1000:.0f}ms total, "
+                f"{latency.mean * 1000:.1f}ms mean, {latency.max * 1000:.0f}ms max, "
+                f"{stats.rows} rows, {stats.wait * 1000:.0f}ms waiting on the pool"
+            )
+            lines.append(template[:300])
+            lines.append("")
+
+        output = "\n".join(lines) or "No queries have been ran yet"
+        await ctx.send(code_block(output))
+
+    @commands.command()
+    async def pool(self, ctx):
+        """Shows how busy the database pool has been recently"""
+        controller = ctx.bot.db.controller
+        if not controller.samples:
+            await ctx.send("The pool hasn't been sampled yet")
+            return
+
+        fmt = "{:<10} {:>6} {:>7} {:>5} {:>7} {:>6}"
+        lines = [fmt.format("Time", "Open", "In use", "Idle", "Queued", "Limit")]
+        for sample in list(controller.samples)[-10:]:
+            lines.append(
+                fmt.format(
+                    time.strftime("%H:%M:%S", time.localtime(sample.time)),
+                    sample.size,
+                    sample.in_use,
+                    sample.idle,
+                    sample.queued,
+                    sample.limit,
+                )
+            )
+        lines.append("")
+        lines.append(
+            "Acquire wait: p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+                *(controller.wait.percentile(q) * 1000 for q in (50, 95, 99)),
+                controller.wait.max * 1000,
+            )
+        )
+        lines.append(
+            f"Adaptive: {controller.adaptive}, {controller.background_in_use} in use by background work"
+        )
+        for replica in ctx.bot.db.replicas:
+            status = "healthy" if replica.healthy else "unhealthy"
+            lag = "unknown" if replica.lag is None else f"{replica.lag:.1f}s"
+            lines.append(f"Replica {replica.name}: {status}, {lag} behind")
+
+        output = "\n".join(lines)
+        await ctx.send(code_block(output))
+
+    @commands.command()
+    async def breakers(self, ctx):
+        """Shows the circuit breaker for each host we've made requests to"""
+        breakers = sorted(utils.http.breakers.values(), key=lambda b: b.host or "")
+        if not breakers:
+            await ctx.send("No requests have been made yet")
+            return
+
+        fmt = "{:<30} {:>9} {:>9} {:>9} {:>9}"
+        lines = [fmt.format("Host", "State", "Success", "Failed", "Rejected")]
+        for breaker in breakers:
+            lines.append(
+                fmt.format(
+                    (breaker.host or "")[:30],
+                    breaker.state,
+                    breaker.successes,
+                    breaker.total_failures,
+                    breaker.rejected,
+                )
+            )
+
+        output = "\n".join(lines)
+        await ctx.send(code_block(output))
+
+    @commands.command()
+    async def httpcache(self, ctx):
+        """Shows how well the response cache, and sharing identical requests, is doing"""
+        cache = utils.http.cache
+        flights = utils.http.flights
+        lookups = cache.hits + cache.negative_hits + cache.misses
+        rate = (cache.hits + cache.negative_hits) / lookups * 100 if lookups else 0
+        await ctx.send(
+            f"Entries: {len(cache.entries)}\n"
+            f"Size: {cache.size / 1024:.0f}KB of {cache.max_bytes / 1024:.0f}KB\n"
+            f"Hits: {cache.hits} ({cache.disk_hits} from disk)\n"
+            f"Empty hits: {cache.negative_hits}\n"
+            f"Misses: {cache.misses}\n"
+            f"Hit rate: {rate:.1f}%\n"
+            f"Evictions: {cache.evictions}\n"
+            f"Requests shared with an identical one in flight: {flights.shared} "
+            f"of {flights.started + flights.shared}"
+        )
+
+    @commands.command()
+    async def startup(self, ctx):
+        """Shows how long each step of starting up took"""
+        await ctx.send(code_block(utils.startup.report()))
+
     @commands.command()
     async def name(self, ctx, new_nick: str):
         """Changes the bot's name"""
@@ -239,7 +399,7 @@ class Owner(commands.Cog):
 
         # This try catch will catch errors such as syntax errors in the module we are loading
         try:
-            ctx.bot.load_extension(module)
+            ctx.bot.lazy.load(module)
             await ctx.send("I have just loaded the {} module".format(module))
         except Exception as error:
             fmt = "An error occurred while processing this request: ```py\n{}: {}\n```"
@@ -265,11 +425,13 @@ class Owner(commands.Cog):
         module = module.lower()
         if not module.startswith("cogs"):
             module = "cogs.{}".format(module)
-        ctx.bot.unload_extension(module)
+        # If it's lazy and hasn't been used yet, there's only a placeholder to replace
+        if module in ctx.bot.extensions:
+            ctx.bot.unload_extension(module)
 
         # This try block will catch errors such as syntax errors in the module we are loading
         try:
-            ctx.bot.load_extension(module)
+            ctx.bot.lazy.load(module)
             await ctx.send("I have just reloaded the {} module".format(module))
         except Exception as error:
             fmt = "An error occurred while processing this request: ```py\n{}: {}\n```"
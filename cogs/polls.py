@@ -48,6 +48,10 @@ class Polls(commands.Cog):
         self.bot = bot
         self.polls = []
 
+    def in_use(self):
+        """Whether there are polls being tracked, which would be lost if this was unloaded"""
+        return bool(self.polls)
+
     async def create_poll(self, ctx, content):
         question, *options = content.split("\n")
         if len(options) == 0 or len(options) > 10:
@@ -14,6 +14,10 @@ class Raffle(commands.Cog):
 
     raffles = defaultdict(list)
 
+    def in_use(self):
+        """Whether there are raffles running, which would be lost if this was unloaded"""
+        return any(self.raffles.values())
+
     def create_raffle(self, ctx, title, num):
         raffle = GuildRaffle(ctx, title, num)
         self.raffles[ctx.guild.id].append(raffle)
@@ -1,5 +1,4 @@
 import asyncio
-import aiohttp
 import traceback
 
 from discord.ext import commands
@@ -40,8 +39,9 @@ class Spotify(commands.Cog):
     async def get_api_token(self):
         url = "https://accounts.spotify.com/api/token"
         opts = {"grant_type": "client_credentials"}
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            response = await session.post(url, data=opts)
+        async with utils.http.session.post(
+            url, data=opts, headers=self.headers
+        ) as response:
             data = await response.json()
             self._token = data.get("access_token")
             return data.get("expires_in")
@@ -14,7 +14,9 @@ class Stats(commands.Cog):
     async def _get_guild_usage(self, guild):
         embed = discord.Embed(title="Server Command Usage")
         count = await self.bot.db.fetchrow(
-            "SELECT COUNT(*), MIN(executed) FROM command_usage WHERE guild=$1", guild.id
+            "SELECT COALESCE(SUM(uses), 0)::bigint, MIN(first_used) FROM command_usage_guild_daily WHERE guild=$1",
+            guild.id,
+            replica_ok=True,
         )
 
         embed.description = f"{count[0]} total commands used"
@@ -24,9 +26,9 @@ class Stats(commands.Cog):
 
         query = """
 SELECT
-    command, COUNT(*) as uses
+    command, SUM(uses)::bigint as uses
 FROM
-    command_usage
+    command_usage_guild_daily
 WHERE
     guild = $1
 GROUP BY
@@ -36,19 +38,36 @@ ORDER BY
 LIMIT 5
         """
 
-        results = await self.bot.db.fetch(query, guild.id)
+        results = await self.bot.db.fetch(query, guild.id, replica_ok=True)
         value = "\n".join(
             f"{command} ({uses} uses)" for command, uses in results or "No Commands"
         )
         embed.add_field(name="Top Commands", value=value)
+        self._add_recent_usage(embed, guild)
 
         return embed
 
+    def _add_recent_usage(self, embed, guild):
+        # These come from the in memory sketches, so they're approximate but never touch the database
+        analytics = self.bot.analytics
+        windows = (("1h", "Last Hour"), ("24h", "Last Day"), ("7d", "Last Week"))
+        for window, name in windows:
+            top = analytics.top_commands(window, guild.id, 3)
+            if not top:
+                continue
+            people = analytics.distinct_users(window, guild.id)
+            lines = [f"~{people} people used commands"]
+            for command, uses in top:
+                people = analytics.distinct_users(window, guild.id, command)
+                lines.append(f"{command} ({uses} uses by ~{people} people)")
+            embed.add_field(name=name, value="\n".join(lines), inline=False)
+
     async def _get_member_usage(self, member):
         embed = discord.Embed(title=f"{member.display_name}'s command usage")
         count = await self.bot.db.fetchrow(
-            "SELECT COUNT(*), MIN(executed) FROM command_usage WHERE author=$1",
+            "SELECT COALESCE(SUM(uses), 0)::bigint, MIN(first_used) FROM command_usage_author_daily WHERE author=$1",
             member.id,
+            replica_ok=True,
         )
 
         embed.description = f"{count[0]} total commands used"
@@ -58,9 +77,9 @@ LIMIT 5
 
         query = """
 SELECT
-    command, COUNT(*) as uses
+    command, SUM(uses)::bigint as uses
 FROM
-    command_usage
+    command_usage_author_daily
 WHERE
     author = $1
 GROUP BY
@@ -70,7 +89,7 @@ ORDER BY
 LIMIT 5
         """
 
-        results = await self.bot.db.fetch(query, member.id)
+        results = await self.bot.db.fetch(query, member.id, replica_ok=True)
         value = "\n".join(
             f"{command} ({uses} uses)" for command, uses in results or "No Commands"
         )
@@ -268,7 +287,9 @@ ORDER BY
     battle_rating DESC
 """
 
-        results = await ctx.bot.db.fetch(query, [m.id for m in ctx.guild.members])
+        results = await ctx.bot.db.fetch(
+            query, [m.id for m in ctx.guild.members], replica_ok=True
+        )
 
         if results is None or len(results) == 0:
             await ctx.send("No one has battled on this server!")
@@ -313,7 +334,9 @@ FROM
 WHERE id = $2
         """
         member_list = [m.id for m in ctx.guild.members]
-        result = await ctx.bot.db.fetchrow(query, member_list, member.id)
+        result = await ctx.bot.db.fetchrow(
+            query, member_list, member.id, replica_ok=True
+        )
         if result is None:
             return await ctx.send("You have not battled!")
         server_rank = result["rank"]
@@ -52,6 +52,7 @@ class Tags(commands.Cog):
     @commands.group(invoke_without_command=True)
     @commands.guild_only()
     @utils.can_run(send_messages=True)
+    @utils.db_session()
     async def tag(self, ctx, *, trigger: str):
         """This can be used to call custom tags
         The format to call a custom tag is !tag <tag>
@@ -65,11 +66,13 @@ class Tags(commands.Cog):
         )
 
         if tag:
-            await ctx.send("\u200B{}".format(tag["result"]))
             await ctx.bot.db.execute(
                 "UPDATE tags SET uses = uses + 1 WHERE id = $1", tag["id"]
             )
+            await ctx.end_db_session()
+            await ctx.send("\u200B{}".format(tag["result"]))
         else:
+            await ctx.end_db_session()
             await ctx.send("There is no tag called {}".format(trigger))
 
     @tag.command(name="add", aliases=["create", "setup"])
@@ -140,6 +140,10 @@ class TicTacToe(commands.Cog):
 
     boards = {}
 
+    def in_use(self):
+        """Whether there are games going on, which would be lost if this was unloaded"""
+        return bool(self.boards)
+
     def create(self, server_id, player1, player2):
         self.boards[server_id] = Board(player1, player2)
 
@@ -149,6 +153,7 @@ class TicTacToe(commands.Cog):
     @commands.group(aliases=["tic", "tac", "toe"], invoke_without_command=True)
     @commands.guild_only()
     @utils.can_run(send_messages=True)
+    @utils.db_session(transaction=True)
     async def tictactoe(self, ctx, *, option: str):
         """Updates the current server's tic-tac-toe board
         You obviously need to be one of the players to use this
@@ -230,13 +235,14 @@ class TicTacToe(commands.Cog):
                 if board.challengers["x"] != winner
                 else board.challengers["o"]
             )
+            # Handle updating ratings based on the winner and loser
+            await utils.update_records("tictactoe", ctx.bot.db, winner, loser)
+            await ctx.end_db_session()
             await ctx.send(
                 "{} has won this game of TicTacToe, better luck next time {}".format(
                     winner.display_name, loser.display_name
                 )
             )
-            # Handle updating ratings based on the winner and loser
-            await utils.update_records("tictactoe", ctx.bot.db, winner, loser)
             # This game has ended, delete it so another one can be made
             try:
                 del self.boards[ctx.message.guild.id]
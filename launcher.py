@@ -0,0 +1,51 @@
+import argparse
+import asyncio
+import logging
+
+import utils
+from utils.cluster import Supervisor
+
+logging.basicConfig(level=logging.INFO, filename="launcher.log")
+
+
+async def recommended_shard_count():
+    """Asks Discord how many shards it recommends we run, None if it couldn't be asked"""
+    try:
+        data = await utils.request(
+            "https://discord.com/api/v8/gateway/bot",
+            headers={"Authorization": f"Bot {utils.bot_token}"},
+        )
+    finally:
+        # This is the only request the launcher makes
+        await utils.http.close()
+    if not data or "shards" not in data:
+        return None
+    return data["shards"]
+
+
+async def main(args):
+    shard_count = args.shard_count or utils.shard_count
+    if shard_count is None:
+        # The fake workers don't connect anywhere, so there's nothing to ask
+        shard_count = args.clusters if args.fake else await recommended_shard_count()
+    if shard_count is None:
+        raise SystemExit(
+            "Couldn't ask Discord how many shards to run, set shard_count in config.yml or pass --shard-count"
+        )
+
+    supervisor = Supervisor(shard_count, args.clusters, fake=args.fake)
+    await supervisor.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the bot as multiple processes, each with their own range of shards"
+    )
+    parser.add_argument("--clusters", type=int, default=utils.clusters)
+    parser.add_argument("--shard-count", type=int, default=None)
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Run fake workers that don't connect to Discord, for testing the supervisor",
+    )
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
@@ -2,6 +2,20 @@ from .cards import Deck, Face, Suit
 from .checks import can_run
 from .config import *
 from .utilities import *
+from .http_client import HTTPClient, RetryPolicy, CircuitBreaker, SingleFlight, http
+from .http_cache import ResponseCache
 from .paginator import Pages, CannotPaginate, HelpPaginator
-from .database import DB, Cache
+from .database import DB, Cache, db_session
+from .usage import (
+    UsageRecorder,
+    backfill_rollups,
+    create_partitions,
+    expire_partitions,
+)
+from .analytics import Analytics, HyperLogLog, SpaceSaving
+from .chunking import ChunkScheduler
+from .cluster import ClusterClient
+from .metrics import Histogram, Timings, QueryStats, timings, query_stats, startup
+from .typing_status import typing_delay, delayed_typing
+from .lazy import LazyExtensions, LazyCommand, LazyGroup
 from .flash_card import FlashCardDisplay, FlashCard
\ No newline at end of file
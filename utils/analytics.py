@@ -0,0 +1,318 @@
+import asyncio
+import base64
+import json
+import logging
+import math
+import time
+import zlib
+
+from collections import defaultdict
+
+from . import config
+
+log = logging.getLogger()
+
+_mask64 = (1 << 64) - 1
+
+
+def _mix(value):
+    """splitmix64, spreads IDs (which share a lot of their high bits) evenly over 64 bits"""
+    value = (value + 0x9E3779B97F4A7C15) & _mask64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _mask64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _mask64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    """Estimates how many distinct IDs have been added, to within ~3%, in at most 1KB
+
+    Registers are kept in a dict until there are enough of them that a flat array is smaller"""
+
+    precision = 10
+    size = 1 << precision
+    # 0.7213 / (1 + 1.079 / size), the bias correction for this many registers
+    alpha = 0.7213 / (1 + 1.079 / size)
+
+    __slots__ = ("registers",)
+
+    def __init__(self, registers=None):
+        self.registers = registers if registers is not None else {}
+
+    def add(self, value):
+        hashed = _mix(value)
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit, the more leading zeros we've seen the more distinct values there are
+        rank = (64 - self.precision) - rest.bit_length() + 1
+
+        if rank > self._rank(index):
+            self.registers[index] = rank
+            self._maybe_densify()
+
+    def _rank(self, index):
+        if isinstance(self.registers, bytearray):
+            return self.registers[index]
+        return self.registers.get(index, 0)
+
+    def _maybe_densify(self):
+        # A dict entry costs roughly 64 times as much as a byte in the array
+        if isinstance(self.registers, dict) and len(self.registers) > self.size // 64:
+            dense = bytearray(self.size)
+            for index, rank in self.registers.items():
+                dense[index] = rank
+            self.registers = dense
+
+    def merge(self, other):
+        items = (
+            enumerate(other.registers)
+            if isinstance(other.registers, bytearray)
+            else other.registers.items()
+        )
+        for index, rank in items:
+            if rank > self._rank(index):
+                self.registers[index] = rank
+        self._maybe_densify()
+
+    def __len__(self):
+        if isinstance(self.registers, bytearray):
+            ranks = self.registers
+            zeros = ranks.count(0)
+        else:
+            ranks = self.registers.values()
+            zeros = self.size - len(self.registers)
+        total = zeros + sum(2.0 ** -rank for rank in ranks if rank)
+        estimate = self.alpha * self.size * self.size / total
+        # Small counts are better estimated from how many registers are still empty
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_json(self):
+        if isinstance(self.registers, bytearray):
+            return base64.b64encode(bytes(self.registers)).decode()
+        return [[index, rank] for index, rank in self.registers.items()]
+
+    @classmethod
+    def from_json(cls, data):
+        if isinstance(data, str):
+            return cls(bytearray(base64.b64decode(data)))
+        return cls({index: rank for index, rank in data})
+
+
+class SpaceSaving:
+    """Keeps (approximately) the k most common items, counts are never under and at most error over"""
+
+    __slots__ = ("capacity", "counts", "errors")
+
+    def __init__(self, capacity=None, counts=None, errors=None):
+        self.capacity = capacity or config.analytics_top_k
+        self.counts = counts or {}
+        self.errors = errors or {}
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            # Replace the least common item, assuming the new one could have been seen that many times
+            smallest = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[item] = floor + count
+            self.errors[item] = floor
+
+    def merge(self, other):
+        for item, count in other.counts.items():
+            self.counts[item] = self.counts.get(item, 0) + count
+            self.errors[item] = self.errors.get(item, 0) + other.errors[item]
+        # Drop back down to our capacity, keeping the most common
+        if len(self.counts) > self.capacity:
+            for item in sorted(self.counts, key=self.counts.get)[
+                : len(self.counts) - self.capacity
+            ]:
+                del self.counts[item]
+                del self.errors[item]
+
+    def top(self, amount):
+        """Returns (item, count) for the most common items"""
+        return sorted(self.counts.items(), key=lambda i: i[1], reverse=True)[:amount]
+
+    def to_json(self):
+        return [[item, count, self.errors[item]] for item, count in self.counts.items()]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            counts={item: count for item, count, _ in data},
+            errors={item: error for item, _, error in data},
+        )
+
+
+class _Bucket:
+    __slots__ = ("users", "commands")
+
+    def __init__(self):
+        # (guild, command) -> HyperLogLog of the users. command is None for any command, (None, None) is everyone
+        self.users = defaultdict(HyperLogLog)
+        # Guild -> SpaceSaving of the commands used there
+        self.commands = defaultdict(SpaceSaving)
+
+    def to_json(self):
+        return {
+            "users": [
+                [guild, command, hll.to_json()]
+                for (guild, command), hll in self.users.items()
+            ],
+            "commands": [
+                [guild, top.to_json()] for guild, top in self.commands.items()
+            ],
+        }
+
+    def merge(self, other):
+        for key, hll in other.users.items():
+            self.users[key].merge(hll)
+        for guild, top in other.commands.items():
+            self.commands[guild].merge(top)
+
+    @classmethod
+    def from_json(cls, data):
+        bucket = cls()
+        for guild, command, hll in data["users"]:
+            bucket.users[(guild, command)] = HyperLogLog.from_json(hll)
+        for guild, top in data["commands"]:
+            bucket.commands[guild] = SpaceSaving.from_json(top)
+        return bucket
+
+
+class Analytics:
+    """Approximate distinct users and top commands over sliding windows, without touching command_usage"""
+
+    # Window name -> (how long it covers, how long each bucket in it covers) in seconds
+    windows = {
+        "1h": (3600, 300),
+        "24h": (86400, 3600),
+        "7d": (604800, 86400),
+    }
+
+    def __init__(self, db, cluster_id=None):
+        self.db = db
+        # Each cluster has its own guilds, so they're saved separately
+        self.cluster_id = cluster_id or 0
+        # Window name -> bucket number -> _Bucket
+        self.buckets = {name: {} for name in self.windows}
+        self._task = None
+
+    def _current(self, name, now):
+        span, size = self.windows[name]
+        number = int(now // size)
+        buckets = self.buckets[name]
+        if number not in buckets:
+            # Once a new bucket starts, anything that has fallen out of the window can go
+            oldest = number - span // size
+            for old in [n for n in buckets if n <= oldest]:
+                del buckets[old]
+            buckets[number] = _Bucket()
+        return buckets[number]
+
+    def _live(self, name):
+        span, size = self.windows[name]
+        oldest = int(time.time() // size) - span // size
+        return [b for n, b in self.buckets[name].items() if n > oldest]
+
+    def record(self, command, guild, author):
+        now = time.time()
+        for name in self.windows:
+            bucket = self._current(name, now)
+            if guild is not None:
+                bucket.users[(guild, command)].add(author)
+                bucket.users[(guild, None)].add(author)
+                bucket.commands[guild].add(command)
+            bucket.users[(None, None)].add(author)
+
+    def distinct_users(self, window, guild=None, command=None):
+        """Roughly how many different people used command (or anything, if None) in guild
+
+        With no guild, this is everyone that used anything, including in DMs"""
+        merged = HyperLogLog()
+        for bucket in self._live(window):
+            hll = bucket.users.get((guild, command))
+            if hll is not None:
+                merged.merge(hll)
+        return len(merged)
+
+    def top_commands(self, window, guild, amount=5):
+        """Returns (command, uses) for the most used commands in this guild"""
+        merged = SpaceSaving()
+        for bucket in self._live(window):
+            top = bucket.commands.get(guild)
+            if top is not None:
+                merged.merge(top)
+        return merged.top(amount)
+
+    def to_json(self):
+        return {
+            name: {
+                str(number): bucket.to_json() for number, bucket in buckets.items()
+            }
+            for name, buckets in self.buckets.items()
+        }
+
+    async def save(self):
+        data = zlib.compress(json.dumps(self.to_json()).encode())
+        await self.db.upsert(
+            "command_analytics",
+            {"cluster": self.cluster_id, "data": data},
+            ["cluster"],
+        )
+
+    async def load(self):
+        data = await self.db.fetchval(
+            "SELECT data FROM command_analytics WHERE cluster = $1", self.cluster_id
+        )
+        if data is None:
+            return
+        # The buckets are numbered by time, so ones that have since fallen out of their window are just never used
+        for name, buckets in json.loads(zlib.decompress(data)).items():
+            if name not in self.windows:
+                continue
+            for number, data in buckets.items():
+                bucket = _Bucket.from_json(data)
+                # Anything recorded while we were loading goes on top of what was saved
+                current = self.buckets[name].get(int(number))
+                if current is not None:
+                    bucket.merge(current)
+                self.buckets[name][int(number)] = bucket
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._save_loop())
+
+    async def close(self):
+        """Stops saving periodically, and saves what we have one last time"""
+        # If we never started, we never loaded, and saving now would throw away what was saved before
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        try:
+            await self.save()
+        except Exception as error:
+            log.warning(
+                "Failed to save analytics: {}: {}".format(
+                    error.__class__.__name__, error
+                )
+            )
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(config.analytics_save_interval)
+            try:
+                await self.save()
+            except Exception as error:
+                log.warning(
+                    "Failed to save analytics: {}: {}".format(
+                        error.__class__.__name__, error
+                    )
+                )
@@ -3,6 +3,9 @@ import asyncio
 from discord.ext import commands
 import discord
 
+from . import config
+from .metrics import timings
+
 loop = asyncio.get_event_loop()
 
 
@@ -23,91 +26,49 @@ async def check_not_restricted(ctx):
     if type(ctx.message.channel) is discord.DMChannel:
         return True
 
-    # First get all the restrictions
-    restrictions = ctx.bot.cache.restrictions[ctx.guild.id]
-    # Now lets check the "from" restrictions
-    for from_restriction in restrictions.get("from", []):
-        # Get the source and destination
-        # Source should ALWAYS be a command in this case
-        source = from_restriction.get("source")
-        destination = from_restriction.get("destination")
-        # Special check for what the "disable" command produces
-        if destination == "everyone" and ctx.command.qualified_name == source:
-            return False
-        # If this isn't the command we care about, continue
-        if source != ctx.command.qualified_name:
-            continue
+    # The restrictions are compiled per command, so most commands won't have an entry at all
+    restrictions = ctx.bot.cache.restriction_index[ctx.guild.id].get(
+        ctx.command.qualified_name
+    )
+    if restrictions is None:
+        return True
+    # Special check for what the "disable" command produces
+    if restrictions.disabled:
+        return False
 
-        # If the destination isn't everyone, then it's an integer
-        destination = int(destination)
+    role_ids = {role.id for role in ctx.author.roles}
 
-        # This means that the type of restriction we have is `command from channel`
-        # Which means we do not want commands to be ran in this channel
-        if destination == ctx.channel.id:
-            return False
-        # This type is `command from Role` meaning anyone with this role can't run this command
-        elif discord.utils.get(ctx.author.roles, id=destination):
-            return False
-        # This is `command from Member` meaning this user specifically cannot run this command
-        elif destination == ctx.author.id:
-            return False
+    # The "from" restrictions are a blacklist, this command can't be ran in this channel,
+    # by anyone with this role, or by this member
+    blocked = restrictions.blocked
+    if blocked and (
+        ctx.channel.id in blocked
+        or ctx.author.id in blocked
+        or not blocked.isdisjoint(role_ids)
+    ):
+        return False
 
-    # If we are here, then there are no blacklists stopping this from running
+    # The "to" restrictions are a whitelist, if there is one then either the channel
+    # or one of the author's roles needs to be in it
+    whitelist = restrictions.whitelist
+    if whitelist:
+        return ctx.channel.id in whitelist or not whitelist.isdisjoint(role_ids)
 
-    # Now for the to restrictions this is a little different, we need to make a whitelist and
-    # see if our current channel is in this whitelist, as well as any whitelisted roles are in the author's roles
-    # Only if there is no whitelist, do we want to blanket return True
-    to_restrictions = restrictions.get("to", [])
-    if not to_restrictions:
-        return True
+    return True
 
-    # If the author has a role that should whitelist them
-    whitelisted_role = False
-    # If this channel is one that is whitelisted
-    whitelisted_channel = False
-    # If a whitelist was found for this command
-    whitelist_found = False
-
-    # Otherwise check whitelists
-    for to_restriction in to_restrictions:
-        # Get the source and destination
-        # Source should ALWAYS be a command in this case
-        source = to_restriction.get("source")
-        destination = int(to_restriction.get("destination"))
-        # If this isn't the source we care about, continue
-        if source != ctx.command.qualified_name:
-            continue
-
-        # If we've found a whitelist valid for this command, now we can set it
-        whitelist_found = True
-        # Now check against roles
-        if not whitelisted_role and discord.utils.get(ctx.author.roles, id=destination):
-            whitelisted_role = True
-        if ctx.channel.id == destination:
-            whitelisted_channel = True
-
-    # If we have reached here, then there is a whitelist... so we just need to return if they matched
-    # the whitelist
-    return whitelisted_role or whitelisted_channel or not whitelist_found
-
-
-def has_perms(ctx, **perms):
+
+def has_perms(ctx, required_perm):
     # Return true if this is a private channel, we'll handle that in the registering of the command
     if type(ctx.message.channel) is discord.DMChannel:
         return True
 
     # Get the member permissions so that we can compare
     guild_perms = ctx.message.author.guild_permissions
-    channel_perms = ctx.message.author.permissions_in(ctx.message.channel)
     # Currently the library doesn't handle administrator overrides..so lets do this manually
     if guild_perms.administrator:
         return True
-    # Next, set the default permissions if one is not used, based on what was passed
-    # This will be overriden later, if we have custom permissions
-    required_perm = discord.Permissions.none()
-    for perm, setting in perms.items():
-        setattr(required_perm, perm, setting)
 
+    # The required permissions are overriden if we have custom permissions
     required_perm_value = ctx.bot.cache.custom_permissions[ctx.guild.id].get(
         ctx.command.qualified_name
     )
@@ -115,13 +76,20 @@ def has_perms(ctx, **perms):
         required_perm = discord.Permissions(required_perm_value)
 
     # Now just check if the person running the command has these permissions
-    return guild_perms >= required_perm or channel_perms >= required_perm
+    if guild_perms >= required_perm:
+        return True
+    return ctx.message.author.permissions_in(ctx.message.channel) >= required_perm
 
 
 def can_run(**kwargs):
-    async def predicate(ctx):
+    # Work out the permissions this command needs once, instead of on every check
+    required_perm = discord.Permissions.none()
+    for perm, setting in kwargs.items():
+        setattr(required_perm, perm, setting)
+
+    async def check(ctx):
         # Next check if it requires any certain permissions
-        if kwargs and not has_perms(ctx, **kwargs):
+        if kwargs and not has_perms(ctx, required_perm):
             return False
         # Next...check custom restrictions
         if not await check_not_restricted(ctx):
@@ -132,5 +100,24 @@ def can_run(**kwargs):
         # Otherwise....we're good
         return True
 
+    async def predicate(ctx):
+        with timings.timer("checks"):
+            # Nothing can stop a command from running in DMs here
+            if ctx.guild is None:
+                return True
+
+            # The decision only changes when roles, overwrites, or our own settings change
+            # and the cache is cleared for the guild whenever one of those does
+            decisions = ctx.bot.cache.decisions[ctx.guild.id]
+            key = (ctx.channel.id, ctx.author.id, ctx.command.qualified_name)
+            decision = decisions.get(key)
+            if decision is None:
+                decision = await check(ctx)
+                if len(decisions) >= config.decision_cache_size:
+                    decisions.clear()
+                decisions[key] = decision
+            return decision
+
     predicate.perms = kwargs
     return commands.check(predicate)
+
@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import logging
+import time
+
+from collections import defaultdict
+
+from . import config
+
+log = logging.getLogger()
+
+
+class ChunkScheduler:
+    """Chunks guilds in the background, one shard at a time, most active and largest guilds first"""
+
+    def __init__(self, bot, *, rate=None):
+        self.bot = bot
+        # The gateway limits how many requests we can send per shard, so space our chunk requests out
+        self.delay = 60 / (rate or config.chunk_requests_per_minute)
+        # Guild ID -> the last time a command was ran in it
+        self.last_activity = {}
+        # Shard ID -> the guild IDs on that shard that still need to be chunked
+        self.pending = defaultdict(set)
+        # Guild ID -> event set once that guild has been chunked, only exists while someone is waiting
+        self.waiters = {}
+        # The guilds currently being chunked
+        self.chunking = set()
+        self._wakeups = defaultdict(asyncio.Event)
+        self._workers = {}
+
+    def start(self):
+        self.bot.add_listener(self.on_guild_available)
+        self.bot.add_listener(self.on_guild_join)
+        self.bot.add_listener(self.on_guild_remove)
+
+    def stop(self):
+        for task in self._workers.values():
+            task.cancel()
+        self._workers.clear()
+
+    def schedule(self, guild):
+        """Adds a guild to the queue of guilds that need chunking"""
+        if guild.chunked or guild.id in self.chunking:
+            return
+
+        self.pending[guild.shard_id].add(guild.id)
+        # Make sure there's a worker running for this shard
+        task = self._workers.get(guild.shard_id)
+        if task is None or task.done():
+            # This is usually scheduled from a command, but the worker outlives it, so it gets none of its context
+            self._workers[guild.shard_id] = contextvars.Context().run(
+                self.bot.loop.create_task, self._worker(guild.shard_id)
+            )
+        self._wakeups[guild.shard_id].set()
+
+    async def wait_for(self, guild, timeout=None):
+        """Waits for this guild to be chunked, returns whether it is chunked when we stop waiting"""
+        if guild.chunked:
+            return True
+
+        # Someone's using this guild, so bump it up the queue
+        self.last_activity[guild.id] = time.monotonic()
+        event = self.waiters.get(guild.id)
+        if event is None:
+            event = self.waiters[guild.id] = asyncio.Event()
+        self.schedule(guild)
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return guild.chunked
+
+    def _priority(self, guild_id):
+        guild = self.bot.get_guild(guild_id)
+        member_count = (guild.member_count or 0) if guild else 0
+        return self.last_activity.get(guild_id, 0), member_count
+
+    def _finish(self, guild_id):
+        self.chunking.discard(guild_id)
+        event = self.waiters.pop(guild_id, None)
+        if event is not None:
+            event.set()
+
+    async def _worker(self, shard_id):
+        pending = self.pending[shard_id]
+        wakeup = self._wakeups[shard_id]
+        while True:
+            if not pending:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+
+            guild_id = max(pending, key=self._priority)
+            pending.discard(guild_id)
+            guild = self.bot.get_guild(guild_id)
+            if guild is None or guild.chunked:
+                self._finish(guild_id)
+                continue
+
+            self.chunking.add(guild_id)
+            try:
+                await guild.chunk()
+            except asyncio.CancelledError:
+                self._finish(guild_id)
+                raise
+            except Exception as error:
+                log.warning(
+                    "Failed to chunk guild {}: {}: {}".format(
+                        guild_id, error.__class__.__name__, error
+                    )
+                )
+            self._finish(guild_id)
+            await asyncio.sleep(self.delay)
+
+    async def on_guild_available(self, guild):
+        self.schedule(guild)
+
+    async def on_guild_join(self, guild):
+        self.schedule(guild)
+
+    async def on_guild_remove(self, guild):
+        self.pending[guild.shard_id].discard(guild.id)
+        self.last_activity.pop(guild.id, None)
+        # Anyone waiting on this guild doesn't need to anymore
+        self._finish(guild.id)
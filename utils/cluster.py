@@ -0,0 +1,290 @@
+import asyncio
+import json
+import logging
+import random
+import signal
+import sys
+import time
+
+from . import config
+
+log = logging.getLogger()
+
+
+def shard_ranges(shard_count, clusters):
+    """Splits the shards into contiguous ranges, one per cluster"""
+    # A cluster without any shards would have nothing to run
+    if not 1 <= clusters <= shard_count:
+        raise ValueError(
+            f"Can't split {shard_count} shards between {clusters} clusters"
+        )
+    per_cluster, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for i in range(clusters):
+        # The first few clusters take one more shard if it doesn't divide evenly
+        end = start + per_cluster + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class ClusterClient:
+    """Reports this process' stats to the supervisor, and keeps the totals across every cluster"""
+
+    keys = ("guilds", "users", "channels")
+
+    def __init__(self, bot, cluster_id=None, port=None):
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.port = port
+        # The totals the supervisor last sent us
+        self.totals = {}
+        # Cluster ID -> that cluster's last report
+        self.clusters = {}
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.cluster_id is not None and self.port is not None
+
+    @property
+    def is_primary(self):
+        """Only one process should do global work, such as posting stats"""
+        return not self.enabled or self.cluster_id == 0
+
+    def local_stats(self):
+        return {
+            "cluster": self.cluster_id,
+            "guilds": len(self.bot.guilds),
+            "users": len(self.bot.users),
+            "channels": len(list(self.bot.get_all_channels())),
+            "latency": self.bot.latency,
+        }
+
+    def total(self, key):
+        """The total across all clusters, or just ours if we aren't clustered/haven't heard back yet"""
+        if key in self.totals:
+            return self.totals[key]
+        return self.local_stats()[key]
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = self.bot.loop.create_task(self._report_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _report_loop(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            except OSError:
+                await asyncio.sleep(config.cluster_heartbeat)
+                continue
+
+            try:
+                while True:
+                    writer.write(json.dumps(self.local_stats()).encode() + b"\n")
+                    await writer.drain()
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    data = json.loads(line)
+                    self.totals = data["totals"]
+                    self.clusters = data["clusters"]
+                    await asyncio.sleep(config.cluster_heartbeat)
+            except OSError as error:
+                log.warning(
+                    "Lost connection to the cluster supervisor: {}: {}".format(
+                        error.__class__.__name__, error
+                    )
+                )
+            except (ValueError, KeyError, TypeError) as error:
+                log.warning(
+                    "Bad response from the cluster supervisor: {}: {}".format(
+                        error.__class__.__name__, error
+                    )
+                )
+            finally:
+                writer.close()
+            # Don't hammer a supervisor that's closing connections, or is still starting up
+            await asyncio.sleep(config.cluster_heartbeat)
+
+
+class Supervisor:
+    """Spawns a worker process per shard range, restarting any that crash or stop reporting"""
+
+    def __init__(self, shard_count, clusters, *, port=None, fake=False):
+        self.shard_count = shard_count
+        if clusters > shard_count:
+            log.warning(
+                "Only running {0} clusters instead of {1}, as there are only {0} shards".format(
+                    shard_count, clusters
+                )
+            )
+            clusters = shard_count
+        self.ranges = shard_ranges(shard_count, clusters)
+        self.port = port or config.cluster_port
+        self.fake = fake
+        self.processes = {}
+        # Cluster ID -> (last report, when it was received)
+        self.reports = {}
+        # Cluster ID -> when it was last heard from, or started if it hasn't reported yet
+        self.last_seen = {}
+        self._closing = False
+
+    def command(self, cluster_id):
+        shard_ids = ",".join(str(s) for s in self.ranges[cluster_id])
+        # A fake worker reports made up stats instead of connecting to the gateway
+        target = ["-m", "utils.cluster"] if self.fake else ["bot.py"]
+        return [
+            sys.executable,
+            *target,
+            "--cluster-id",
+            str(cluster_id),
+            "--shard-ids",
+            shard_ids,
+            "--shard-count",
+            str(self.shard_count),
+            "--supervisor-port",
+            str(self.port),
+        ]
+
+    def totals(self):
+        return {
+            key: sum(report[key] for report, _ in self.reports.values())
+            for key in ClusterClient.keys
+        }
+
+    async def handle_worker(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                report = json.loads(line)
+                self.reports[report["cluster"]] = (report, time.monotonic())
+                self.last_seen[report["cluster"]] = time.monotonic()
+                response = {
+                    "totals": self.totals(),
+                    "clusters": {c: r for c, (r, _) in self.reports.items()},
+                }
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        finally:
+            writer.close()
+
+    async def run_worker(self, cluster_id):
+        """Keeps a worker running, restarting it with a backoff when it exits"""
+        delay = 1
+        while not self._closing:
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(*self.command(cluster_id))
+            self.processes[cluster_id] = proc
+            # So one that hangs before it ever reports is still restarted
+            self.last_seen[cluster_id] = started
+            log.info(
+                "Started cluster {} (pid {}) with shards {}".format(
+                    cluster_id, proc.pid, self.ranges[cluster_id]
+                )
+            )
+            code = await proc.wait()
+            self.reports.pop(cluster_id, None)
+            self.last_seen.pop(cluster_id, None)
+            if self._closing:
+                break
+
+            # If it ran for a while it was probably healthy, so don't hold the restart back
+            if time.monotonic() - started > 60:
+                delay = 1
+            log.warning(
+                "Cluster {} exited with {}, restarting in {}s".format(
+                    cluster_id, code, delay
+                )
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def check_health(self):
+        """Kills workers that have stopped reporting, run_worker will then restart them"""
+        while not self._closing:
+            await asyncio.sleep(config.cluster_heartbeat)
+            now = time.monotonic()
+            for cluster_id, seen in list(self.last_seen.items()):
+                if now - seen > config.cluster_health_timeout:
+                    log.warning(
+                        "Cluster {} hasn't reported in {:.0f}s, killing it".format(
+                            cluster_id, now - seen
+                        )
+                    )
+                    self.reports.pop(cluster_id, None)
+                    self.last_seen.pop(cluster_id, None)
+                    proc = self.processes.get(cluster_id)
+                    if proc is not None and proc.returncode is None:
+                        proc.kill()
+
+    def close(self):
+        self._closing = True
+        for proc in self.processes.values():
+            if proc.returncode is None:
+                proc.terminate()
+
+    async def run(self):
+        server = await asyncio.start_server(self.handle_worker, "127.0.0.1", self.port)
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.close)
+
+        async with server:
+            workers = [
+                loop.create_task(self.run_worker(i)) for i in range(len(self.ranges))
+            ]
+            health = loop.create_task(self.check_health())
+            await asyncio.gather(*workers)
+            health.cancel()
+
+
+async def _fake_worker(cluster_id, shard_ids, port):
+    """Pretends to be a bot running these shards, for testing the supervisor without Discord"""
+
+    class FakeBot:
+        loop = asyncio.get_event_loop()
+        guilds = [None] * (len(shard_ids) * 100)
+        users = [None] * (len(shard_ids) * 1000)
+
+        @property
+        def latency(self):
+            return random.uniform(0.05, 0.2)
+
+        def get_all_channels(self):
+            return iter([None] * (len(shard_ids) * 500))
+
+    client = ClusterClient(FakeBot(), cluster_id, port)
+    client.start()
+    while True:
+        await asyncio.sleep(config.cluster_heartbeat)
+        log.info("Cluster {} sees totals {}".format(cluster_id, client.totals))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cluster-id", type=int)
+    parser.add_argument("--shard-ids")
+    parser.add_argument("--shard-count", type=int)
+    parser.add_argument("--supervisor-port", type=int)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(
+        _fake_worker(
+            args.cluster_id,
+            [int(s) for s in args.shard_ids.split(",")],
+            args.supervisor_port,
+        )
+    )
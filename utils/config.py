@@ -10,7 +10,10 @@ global_config = {}
 try:
     with open("config.yml", "r") as f:
         global_config = yaml.safe_load(f)
-        global_config = {k: v for k, v in global_config.items() if v}
+        # Only drop what was left blank, so false, 0 and {} still override the defaults
+        global_config = {
+            k: v for k, v in global_config.items() if v is not None and v != ""
+        }
 except FileNotFoundError:
     print(
         "You have no config file setup! Please use config.yml.sample to setup a valid config file"
@@ -49,6 +52,49 @@ lol_key = global_config.get("lol_key", "")
 dev_server = global_config.get("dev_server", "")
 # The User-Agent that we'll use for most requests
 user_agent = global_config.get("user_agent", None)
+# The most connections open at once across every site, and to any one site
+http_connection_limit = global_config.get("http_connection_limit", 100)
+http_connection_limit_per_host = global_config.get("http_connection_limit_per_host", 10)
+# How long (in seconds) DNS lookups are cached, and idle connections are kept open for reuse
+http_dns_cache_ttl = global_config.get("http_dns_cache_ttl", 300)
+http_keepalive_timeout = global_config.get("http_keepalive_timeout", 30)
+# How many times a request is tried, for which statuses, and how long (in seconds) it can take overall
+http_retry_attempts = global_config.get("http_retry_attempts", 3)
+http_retry_statuses = global_config.get("http_retry_statuses", [429, 500, 502, 503, 504])
+http_retry_deadline = global_config.get("http_retry_deadline", 15)
+# The most (in seconds) to wait before the first retry, doubling each time up to the max
+http_retry_backoff = global_config.get("http_retry_backoff", 0.5)
+http_retry_max_backoff = global_config.get("http_retry_max_backoff", 5)
+# Overrides for the above, keyed by host or host and path, such as {"api.picarto.tv": {"attempts": 1}}
+http_retry_policies = global_config.get("http_retry_policies", {})
+# Failures in a row before we stop requesting from a host, and how long (in seconds) until we try it again
+http_breaker_threshold = global_config.get("http_breaker_threshold", 5)
+http_breaker_reset = global_config.get("http_breaker_reset", 30)
+# How long (in seconds) responses are cached for, keyed by host or host and path. Anything not here isn't cached
+http_cache_ttls = global_config.get(
+    "http_cache_ttls",
+    {
+        "en.wikipedia.org/w/api.php": 3600,
+        "api.urbandictionary.com": 3600,
+        "jisho.org/api": 86400,
+        "graphql.anilist.co": 600,
+        "www.googleapis.com/youtube": 3600,
+        "api.spotify.com/v1/search": 3600,
+    },
+)
+# How long (in seconds) empty responses are cached for, at most
+http_cache_negative_ttl = global_config.get("http_cache_negative_ttl", 60)
+# The most bytes of responses to keep in memory
+http_cache_max_bytes = global_config.get("http_cache_max_bytes", 16 * 1024 * 1024)
+# If set, responses evicted from memory (or left on shutdown) are kept in this directory
+http_cache_dir = global_config.get("http_cache_dir", None)
+# The largest image (in bytes) we'll download, and the size past which it's kept on disk instead of in memory
+image_max_size = global_config.get("image_max_size", 8 * 1024 * 1024)
+image_spool_threshold = global_config.get("image_spool_threshold", 1024 * 1024)
+# The content types we'll accept when downloading an image
+image_content_types = global_config.get(
+    "image_content_types", ["image/png", "image/jpeg", "image/gif", "image/webp"]
+)
 # The URL to proxy youtube_dl's requests through
 ytdl_proxy = global_config.get("youtube_dl_proxy", None)
 # The patreon key, as well as the patreon ID to use
@@ -60,6 +106,33 @@ spotify_id = global_config.get("spotify_id", None)
 spotify_secret = global_config.get("spotify_secret", None)
 # Error channel to send uncaught exceptions to
 error_channel = global_config.get("error_channel", None)
+# How often (in milliseconds) command usage is written to the database, and how many rows per write
+usage_flush_interval = global_config.get("usage_flush_interval", 5000)
+usage_flush_size = global_config.get("usage_flush_size", 500)
+# The most command usage rows to hold in memory before new ones get dropped
+usage_max_queue = global_config.get("usage_max_queue", 10000)
+# How many months ahead to create command_usage partitions for
+usage_partitions_ahead = global_config.get("usage_partitions_ahead", 3)
+# How many months of command_usage to keep, older partitions are dropped. Leave unset to keep everything
+usage_retention_months = global_config.get("usage_retention_months", None)
+# If set, partitions are written to a gzipped csv in this directory before they're dropped
+usage_archive_dir = global_config.get("usage_archive_dir", None)
+# How many of the most used commands per guild are tracked for !command stats, more is more accurate
+analytics_top_k = global_config.get("analytics_top_k", 20)
+# How often (in seconds) the command analytics are saved, so they survive a restart
+analytics_save_interval = global_config.get("analytics_save_interval", 300)
+# How many guilds a shard can request chunks for per minute
+chunk_requests_per_minute = global_config.get("chunk_requests_per_minute", 30)
+# How long (in seconds) a command waits on its guild being chunked, before running anyway
+chunk_wait_timeout = global_config.get("chunk_wait_timeout", 5)
+# How many can_run results to remember per guild, before forgetting them all
+decision_cache_size = global_config.get("decision_cache_size", 10000)
+# How long (in seconds) a command can run before we show that we're typing
+typing_threshold = global_config.get("typing_threshold", 1.0)
+# How many times a command has to have been ran before we trust its latency to start typing right away
+typing_min_samples = global_config.get("typing_min_samples", 20)
+# The local port to serve latency metrics on (in the Prometheus format), leave unset to not serve them
+metrics_port = global_config.get("metrics_port", None)
 
 # The extensions to load
 extensions = [
@@ -89,6 +162,25 @@ extensions = [
     "cogs.japanese",
 ]
 
+# Extensions that are only loaded the first time one of their commands (or listeners) is used
+# These need to be in utils/extension_manifest.json, which isn't committed as it depends on the cogs you run
+# Generate it with `python -m utils.lazy` whenever commands change (`--check` fails if it's out of date),
+# the bot won't start if it's missing or out of date for these
+lazy_extensions = global_config.get("lazy_extensions", [])
+# How long (in seconds) a lazily loaded extension can go unused before it's unloaded, unset to never unload
+# Extensions with something going on, such as a game in progress, are left loaded until it's over
+lazy_unload_after = global_config.get("lazy_unload_after", None)
+
+# How many processes to split the shards across when using launcher.py
+clusters = global_config.get("clusters", 1)
+# The total amount of shards across all clusters, if not set Discord's recommended amount is used
+shard_count = global_config.get("shard_count", None)
+# The local port the cluster supervisor listens on for its workers
+cluster_port = global_config.get("cluster_port", 8765)
+# How often (in seconds) workers report to the supervisor, and how long until one is considered dead
+cluster_heartbeat = global_config.get("cluster_heartbeat", 5)
+cluster_health_timeout = global_config.get("cluster_health_timeout", 60)
+
 
 # The default status the bot will use
 default_status = global_config.get("default_status", None)
@@ -112,6 +204,32 @@ db_opts = {
 }
 
 
+# Apply any pending schema migrations when starting up, otherwise run `python -m utils.migrations`
+db_migrate_on_startup = global_config.get("db_migrate_on_startup", True)
+# How many prepared statements each database connection keeps around
+db_statement_cache_size = global_config.get("db_statement_cache_size", 256)
+# Queries that take longer than this (in milliseconds) are logged, with their parameters redacted
+slow_query_threshold = global_config.get("slow_query_threshold", 200)
+# The chance (0-1) that a slow read also has EXPLAIN (ANALYZE, BUFFERS) ran on it and logged
+slow_query_explain_rate = global_config.get("slow_query_explain_rate", 0)
+# The least and most connections the database pool will have open
+db_pool_min_size = global_config.get("db_pool_min_size", 10)
+db_pool_max_size = global_config.get("db_pool_max_size", 20)
+# Start at the minimum and allow more connections as queries start waiting, then drop back down when idle
+db_pool_adaptive = global_config.get("db_pool_adaptive", False)
+# Connections that only commands can use, so background work can't starve them
+db_pool_reserved = global_config.get("db_pool_reserved", 2)
+# How often (in seconds) the pool's usage is sampled
+db_pool_sample_interval = global_config.get("db_pool_sample_interval", 5)
+# DSNs of read replicas, reads that don't need to be completely up to date are spread across these
+db_replicas = global_config.get("db_replicas", [])
+# How often (in seconds) replicas are checked, and how far behind they can be before we stop using them
+db_replica_check_interval = global_config.get("db_replica_check_interval", 10)
+db_replica_max_lag = global_config.get("db_replica_max_lag", 30)
+# How long (in seconds) someone reads from the primary after writing, so they see their own changes
+db_replica_pin_time = global_config.get("db_replica_pin_time", 60)
+
+
 def command_prefix(bot, message):
     if not message.guild:
         return default_prefix
@@ -1,46 +1,202 @@
 import asyncio
 import asyncpg
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
 
 from collections import defaultdict
+from discord.ext import commands
 
-from . import config
+from . import config, migrations
+from .metrics import timings, query_stats, startup
+from .pool import PoolController
+
+log = logging.getLogger()
+
+# The calls that only read, anything else is assumed to write
+_reads = ("fetch", "fetchrow", "fetchval")
+# Errors that mean we couldn't talk to the server, rather than anything wrong with the query
+_connection_errors = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+def _count_rows(call, result):
+    if isinstance(result, list):
+        return len(result)
+    # execute returns the command's status, such as "UPDATE 3"
+    if call == "execute" and isinstance(result, str):
+        count = result.rsplit(" ", 1)[-1]
+        return int(count) if count.isdigit() else 0
+    return 0 if result is None else 1
+
+
+def _redact(args):
+    """Describes the parameters without showing what they are"""
+    redacted = []
+    for arg in args:
+        if isinstance(arg, (str, list, tuple, bytes)):
+            redacted.append(f"{type(arg).__name__}[{len(arg)}]")
+        else:
+            redacted.append(type(arg).__name__)
+    return ", ".join(redacted)
+
+
+class CommandRestrictions:
+    """The restrictions on one command in one guild, compiled down to sets of IDs"""
+
+    __slots__ = ("disabled", "blocked", "whitelist")
+
+    def __init__(self):
+        # Set by the disable command, no one can run this anywhere
+        self.disabled = False
+        # Channel, role, and member IDs this command can't be ran from/by
+        self.blocked = set()
+        # Channel and role IDs this command can only be ran in/by
+        self.whitelist = set()
+
+    def __bool__(self):
+        return self.disabled or bool(self.blocked) or bool(self.whitelist)
+
+    def update(self, from_to, destination, add=True):
+        if destination == "everyone":
+            if from_to == "from":
+                self.disabled = add
+            return
+        ids = self.blocked if from_to == "from" else self.whitelist
+        if add:
+            ids.add(int(destination))
+        else:
+            ids.discard(int(destination))
 
 
 class Cache:
     """A class to hold the entires that are called on every message/command"""
 
+    # The channel that other processes are told about changes to the cache on
+    channel = "bonfire_cache"
+    # The kinds of entries that can be reloaded for a guild, each is an attribute with a load_ method
+    kinds = ("prefixes", "ignored", "custom_permissions", "restrictions")
+
     def __init__(self, db):
         self.db = db
         self.prefixes = {}
         self.ignored = defaultdict(dict)
         self.custom_permissions = defaultdict(dict)
         self.restrictions = defaultdict(dict)
+        # Guild ID -> command name -> CommandRestrictions
+        self.restriction_index = defaultdict(dict)
+        # Guild ID -> (channel ID, member ID, command name) -> whether utils.can_run passed
+        self.decisions = defaultdict(dict)
+        # Used to ignore our own notifications
+        self.origin = uuid.uuid4().hex
+        self._listener = None
 
     async def setup(self):
         # Make sure db is setup first
-        await self.db.setup()
+        with startup.timer("database connect"):
+            await self.db.setup()
+
+        # Start listening before loading, so nothing changed during the load gets missed
+        await self.listen()
+
+        # None of these depend on each other, so load them at the same time on their own connections
+        await asyncio.gather(
+            self._timed_load(self.load_prefixes),
+            self._timed_load(self.load_custom_permissions),
+            self._timed_load(self.load_restrictions),
+            self._timed_load(self.load_ignored),
+        )
+
+    async def _timed_load(self, load):
+        with startup.timer(f"cache {load.__name__}"):
+            await load()
+
+    async def listen(self):
+        """Opens a connection (outside of the pool, since it has to stay open) to listen for changes"""
+        self._listener = await asyncpg.connect(**self.db.opts)
+        await self._listener.add_listener(self.channel, self._on_notification)
+        self._listener.add_termination_listener(self._on_listener_closed)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.remove_termination_listener(self._on_listener_closed)
+            await self._listener.close()
+            self._listener = None
 
-        await self.load_prefixes()
-        await self.load_custom_permissions()
-        await self.load_restrictions()
-        await self.load_ignored()
+    def _on_notification(self, connection, pid, channel, payload):
+        data = json.loads(payload)
+        if data["origin"] == self.origin or data["kind"] not in self.kinds:
+            return
+        asyncio.get_event_loop().create_task(self.reload(data["kind"], data["guild"]))
 
-    async def load_ignored(self):
+    def _on_listener_closed(self, connection):
+        asyncio.get_event_loop().create_task(self._relisten())
+
+    async def _relisten(self):
+        while True:
+            try:
+                await self.listen()
+            except (OSError, asyncpg.PostgresError):
+                await asyncio.sleep(5)
+            else:
+                break
+        # We could have missed anything while disconnected, so this is the only time everything gets reloaded
+        for kind in self.kinds:
+            await self.reload(kind)
+
+    async def notify(self, kind, guild_id):
+        """Tells every other process that this kind of entry changed for this guild"""
+        payload = json.dumps({"kind": kind, "guild": guild_id, "origin": self.origin})
+        await self.db.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+    async def invalidate(self, kind, guild_id):
+        """Reloads this kind of entry for this guild, here and in every other process"""
+        await self.reload(kind, guild_id)
+        await self.notify(kind, guild_id)
+
+    async def reload(self, kind, guild_id=None):
+        """Reloads one kind of entry, for just one guild if provided"""
+        await getattr(self, f"load_{kind}")(guild_id)
+        self.clear_decisions(guild_id)
+
+    def clear_decisions(self, guild_id=None):
+        """Forgets the cached can_run results for a guild (or every guild), they'll be rechecked on next use"""
+        if guild_id is None:
+            self.decisions.clear()
+        else:
+            self.decisions.pop(guild_id, None)
+
+    async def load_ignored(self, guild_id=None):
         query = """
 SELECT
     id, ignored_channels, ignored_members
 FROM
     guilds
 WHERE
-    array_length(ignored_channels, 1) > 0 OR
-    array_length(ignored_members, 1) > 0
+    (array_length(ignored_channels, 1) > 0 OR
+    array_length(ignored_members, 1) > 0)
 """
-        rows = await self.db.fetch(query)
+        if guild_id is None:
+            rows = await self.db.fetch(query)
+            # Only replaced once the rows are here, so nothing is ever checked against an empty cache
+            self.ignored = defaultdict(dict)
+        else:
+            rows = await self.db.fetch(query + "AND id = $1", guild_id)
+            self.ignored.pop(guild_id, None)
         for row in rows:
             self.ignored[row['id']]['members'] = row['ignored_members']
             self.ignored[row['id']]['channels'] = row['ignored_channels']
 
-    async def load_prefixes(self):
+    async def load_prefixes(self, guild_id=None):
         query = """
 SELECT
     id, prefix
@@ -49,14 +205,19 @@ FROM
 WHERE
     prefix IS NOT NULL
 """
-        rows = await self.db.fetch(query)
+        if guild_id is None:
+            rows = await self.db.fetch(query)
+            self.prefixes = {}
+        else:
+            rows = await self.db.fetch(query + "AND id = $1", guild_id)
+            self.prefixes.pop(guild_id, None)
         for row in rows:
             self.prefixes[row['id']] = row['prefix']
 
     def update_prefix(self, guild, prefix):
         self.prefixes[guild.id] = prefix
 
-    async def load_custom_permissions(self):
+    async def load_custom_permissions(self, guild_id=None):
         query = """
 SELECT
     guild, command, permission
@@ -65,37 +226,226 @@ FROM
 WHERE
     permission IS NOT NULL
 """
-        rows = await self.db.fetch(query)
+        if guild_id is None:
+            rows = await self.db.fetch(query)
+            self.custom_permissions = defaultdict(dict)
+        else:
+            rows = await self.db.fetch(query + "AND guild = $1", guild_id)
+            self.custom_permissions.pop(guild_id, None)
         for row in rows:
             self.custom_permissions[row['guild']][row['command']] = row['permission']
 
     def update_custom_permission(self, guild, command, permission):
         self.custom_permissions[guild.id][command.qualified_name] = permission
+        self.clear_decisions(guild.id)
 
-    async def load_restrictions(self):
+    async def load_restrictions(self, guild_id=None):
         query = """
 SELECT
     guild, source, from_to, destination
 FROM
     restrictions
 """
-        rows = await self.db.fetch(query)
+        if guild_id is None:
+            rows = await self.db.fetch(query)
+            self.restrictions = defaultdict(dict)
+            self.restriction_index = defaultdict(dict)
+        else:
+            rows = await self.db.fetch(query + "WHERE guild = $1", guild_id)
+            self.restrictions.pop(guild_id, None)
+            self.restriction_index.pop(guild_id, None)
         for row in rows:
             opt = {"source": row['source'], "destination": row['destination']}
             from_restrictions = self.restrictions[row['guild']].get(row['from_to'], [])
             from_restrictions.append(opt)
             self.restrictions[row['guild']][row['from_to']] = from_restrictions
+            self._index_restriction(row['guild'], row['from_to'], opt)
+
+    def _index_restriction(self, guild_id, from_to, restriction, add=True):
+        commands = self.restriction_index[guild_id]
+        entry = commands.get(restriction["source"])
+        if entry is None:
+            if not add:
+                return
+            entry = commands[restriction["source"]] = CommandRestrictions()
+        entry.update(from_to, restriction["destination"], add)
+        # Don't keep empty entries around, the check can skip commands with none
+        if not entry:
+            del commands[restriction["source"]]
 
     def add_restriction(self, guild, from_to, restriction):
         restrictions = self.restrictions[guild.id].get(from_to, [])
         restrictions.append(restriction)
         self.restrictions[guild.id][from_to] = restrictions
+        self._index_restriction(guild.id, from_to, restriction)
+        self.clear_decisions(guild.id)
 
     def remove_restriction(self, guild, from_to, restriction):
         restrictions = self.restrictions[guild.id].get(from_to, [])
         if restriction in restrictions:
             restrictions.remove(restriction)
             self.restrictions[guild.id][from_to] = restrictions
+            self._index_restriction(guild.id, from_to, restriction, add=False)
+            self.clear_decisions(guild.id)
+
+
+def db_session(transaction=False):
+    """Has every query the command makes go through one connection, held until the command finishes
+
+    If transaction is True, they're all ran in one transaction as well, which is rolled back if the command fails
+    Commands should call ctx.end_db_session() once they're done with the database, before sending anything"""
+
+    def decorator(func):
+        callback = func.callback if isinstance(func, commands.Command) else func
+        callback.db_session = {"transaction": transaction}
+        return func
+
+    return decorator
+
+
+class Session:
+    """A connection held for the length of one command, it's only acquired once a query needs it"""
+
+    def __init__(self, db, *, transaction=False):
+        self.db = db
+        self.transaction = transaction
+        self.connection = None
+        self.closed = False
+        self._transaction = None
+        self._background = False
+        # A connection can only run one query at a time
+        self._lock = asyncio.Lock()
+
+    async def _query(self, call, query, *args, transaction=False, **kwargs):
+        with timings.timer("db"):
+            start = time.perf_counter()
+            async with self._lock:
+                if self.connection is None:
+                    self._background = self.db.controller.is_background()
+                    await self.db.controller.acquire(self._background)
+                    try:
+                        self.connection = await self.db._pool.acquire()
+                    except BaseException:
+                        self.db.controller.release(self._background)
+                        raise
+                    if self.transaction:
+                        self._transaction = self.connection.transaction()
+                        await self._transaction.start()
+                acquired = time.perf_counter()
+
+                method = getattr(self.connection, call)
+                # If we're already in the session's transaction, this is already part of one
+                if not transaction or self._transaction is not None:
+                    result = await method(query, *args, **kwargs)
+                else:
+                    async with self.connection.transaction():
+                        result = await method(query, *args, **kwargs)
+
+            self.db.observe(
+                call,
+                query,
+                args,
+                acquired - start,
+                time.perf_counter() - acquired,
+                result,
+            )
+            if call not in _reads:
+                self.db.pin()
+            return result
+
+    async def close(self, *, commit=True):
+        self.closed = True
+        async with self._lock:
+            if self.connection is None:
+                return
+            try:
+                if self._transaction is not None:
+                    if commit:
+                        await self._transaction.commit()
+                    else:
+                        await self._transaction.rollback()
+            finally:
+                await self.db._pool.release(self.connection)
+                self.db.controller.release(self._background)
+                self.connection = None
+                self._transaction = None
+
+
+class Replica:
+    """A read only copy of the database, that reads which can be slightly stale can be sent to"""
+
+    # Whether it's actually a replica, and how far behind the primary it is in seconds
+    # 0 if it has replayed everything it's received. A primary would also say 0, hence checking recovery
+    lag_query = """
+SELECT
+    pg_is_in_recovery() AS replica,
+    CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+"""
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+        # Whether pg_is_in_recovery() said it was a replica last time, None until it's been checked
+        self.in_recovery = None
+
+    async def check(self):
+        try:
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(
+                    dsn=self.dsn,
+                    min_size=1,
+                    max_size=config.db_pool_max_size,
+                    statement_cache_size=config.db_statement_cache_size,
+                )
+            row = await self.pool.fetchrow(self.lag_query, timeout=5)
+        except (*_connection_errors, asyncpg.PostgresError) as error:
+            self.mark_unhealthy(error)
+            return
+
+        # Most likely misconfigured, or it's been promoted. Either way it isn't a copy of the primary
+        if not row["replica"]:
+            if self.in_recovery is not False:
+                log.warning(
+                    "Replica {} isn't in recovery, so it's not a replica. Not sending reads to it".format(
+                        self.name
+                    )
+                )
+            self.in_recovery = False
+            self.lag = None
+            self.healthy = False
+            return
+
+        self.in_recovery = True
+        self.lag = float(row["lag"])
+        healthy = self.lag <= config.db_replica_max_lag
+        if healthy and not self.healthy:
+            log.info("Sending reads to replica {}".format(self.name))
+        elif not healthy and self.healthy:
+            log.warning(
+                "Replica {} is {:.1f}s behind, not sending reads to it".format(
+                    self.name, self.lag
+                )
+            )
+        self.healthy = healthy
+
+    def mark_unhealthy(self, error):
+        if self.healthy:
+            log.warning(
+                "Replica {} is unavailable, not sending reads to it: {}: {}".format(
+                    self.name, error.__class__.__name__, error
+                )
+            )
+        self.healthy = False
+
+    @property
+    def name(self):
+        # Don't log the password
+        return self.dsn.rsplit("@", 1)[-1]
 
 
 class DB:
@@ -104,21 +454,177 @@ class DB:
         self.opts = config.db_opts
         self.cache = {}
         self._pool = None
+        # The session for the command currently running, if it asked for one
+        self.current_session = contextvars.ContextVar("db_session", default=None)
+        self.controller = PoolController()
+        self.replicas = [Replica(dsn) for dsn in config.db_replicas]
+        self._next_replica = 0
+        self._replica_task = None
+        # Whoever is running the current command, so once they've written they read from the primary for a while
+        self.pin_key = contextvars.ContextVar("db_pin_key", default=None)
+        # Pin key -> when they can go back to reading from replicas
+        self._pins = {}
 
     async def connect(self):
-        self._pool = await asyncpg.create_pool(**self.opts)
+        # asyncpg prepares every query as a named statement, and keeps the most recent ones per connection
+        # make sure that cache is big enough that our query templates aren't constantly being re-parsed
+        self._pool = await asyncpg.create_pool(
+            **self.opts,
+            min_size=self.controller.min_size,
+            max_size=self.controller.max_size,
+            statement_cache_size=config.db_statement_cache_size,
+        )
+        self.controller.start(self._pool)
+        if self.replicas:
+            await asyncio.gather(*(replica.check() for replica in self.replicas))
+            self._replica_task = self.loop.create_task(self._check_replicas())
+
+    def close(self):
+        self.controller.stop()
+        if self._replica_task is not None:
+            self._replica_task.cancel()
+            self._replica_task = None
+
+    async def _check_replicas(self):
+        while True:
+            await asyncio.sleep(config.db_replica_check_interval)
+            await asyncio.gather(*(replica.check() for replica in self.replicas))
+
+    def pick_replica(self):
+        """Returns the next healthy replica, or None if reads should go to the primary"""
+        key = self.pin_key.get()
+        if key is not None and self._pins.get(key, 0) > time.monotonic():
+            return None
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        self._next_replica = (self._next_replica + 1) % len(healthy)
+        return healthy[self._next_replica]
+
+    def pin(self):
+        """Sends this context's reads to the primary for a while, so it sees what it just wrote"""
+        key = self.pin_key.get()
+        if key is None or not self.replicas:
+            return
+
+        now = time.monotonic()
+        if len(self._pins) > 1000:
+            self._pins = {k: until for k, until in self._pins.items() if until > now}
+        self._pins[key] = now + config.db_replica_pin_time
 
     async def setup(self):
         await self.connect()
+        if config.db_migrate_on_startup:
+            with startup.timer("database migrations"):
+                async with self._pool.acquire() as connection:
+                    await migrations.apply(connection)
+
+    def session(self, *, transaction=False):
+        """Starts a session that every query made from this task (and ones it starts) will use until it's closed"""
+        session = Session(self, transaction=transaction)
+        self.current_session.set(session)
+        return session
+
+    async def _query(
+        self, call, query, *args, transaction=False, replica_ok=False, **kwargs
+    ):
+        """this will acquire a connection and make the call, then return the result
+        a single statement doesn't need a transaction, so one is only used if asked for
+        reads that can be slightly out of date can pass replica_ok to go to a replica if there is one"""
+        session = self.current_session.get()
+        if session is not None and not session.closed:
+            return await session._query(
+                call, query, *args, transaction=transaction, **kwargs
+            )
+
+        if replica_ok and call in _reads:
+            replica = self.pick_replica()
+            if replica is not None:
+                try:
+                    return await self._run(
+                        replica.pool, call, query, args, kwargs, transaction
+                    )
+                except _connection_errors as error:
+                    # Just fall back to the primary, the health check will bring it back
+                    replica.mark_unhealthy(error)
+
+        result = await self._run(self._pool, call, query, args, kwargs, transaction)
+        if call not in _reads:
+            self.pin()
+        return result
+
+    async def _run(self, pool, call, query, args, kwargs, transaction):
+        with timings.timer("db"):
+            start = time.perf_counter()
+            async with contextlib.AsyncExitStack() as stack:
+                # Replicas only get reads, so there's nothing there that commands need to be prioritised over
+                if pool is self._pool:
+                    await stack.enter_async_context(self.controller.slot())
+                connection = await stack.enter_async_context(pool.acquire())
+                acquired = time.perf_counter()
+                if not transaction:
+                    result = await getattr(connection, call)(query, *args, **kwargs)
+                else:
+                    async with connection.transaction():
+                        result = await getattr(connection, call)(query, *args, **kwargs)
+
+            self.observe(
+                call,
+                query,
+                args,
+                acquired - start,
+                time.perf_counter() - acquired,
+                result,
+            )
+            return result
+
+    def observe(self, call, query, args, wait, seconds, result):
+        """Records the query's stats, and logs it if it was slow"""
+        rows = _count_rows(call, result)
+        template = query_stats.observe(query, seconds, wait, rows)
+        if seconds * 1000 < config.slow_query_threshold:
+            return
+
+        log.warning(
+            "Slow query ({:.0f}ms, {} rows): {} with ({})".format(
+                seconds * 1000, rows, template, _redact(args)
+            )
+        )
+        # Only reads are EXPLAIN ANALYZE'd, as that actually runs the query again
+        if call in _reads and random.random() < config.slow_query_explain_rate:
+            # Not in this context, or it would run in the command's session (and transaction) if it has one
+            contextvars.Context().run(
+                self.loop.create_task, self.explain(template, query, args)
+            )
 
-    async def _query(self, call, query, *args, **kwargs):
-        """this will acquire a connection and make the call, then return the result"""
-        async with self._pool.acquire() as connection:
-            async with connection.transaction():
-                return await getattr(connection, call)(query, *args, **kwargs)
+    async def explain(self, template, query, args):
+        """Runs EXPLAIN (ANALYZE, BUFFERS) on the query, saving and logging the plan"""
+        try:
+            async with self.controller.slot(), self._pool.acquire() as connection:
+                # ANALYZE really runs it, so make sure nothing it does can stick
+                transaction = connection.transaction()
+                await transaction.start()
+                try:
+                    rows = await connection.fetch(
+                        f"EXPLAIN (ANALYZE, BUFFERS) {query}", *args
+                    )
+                finally:
+                    await transaction.rollback()
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as error:
+            log.warning(
+                "Couldn't explain slow query {}: {}: {}".format(
+                    template, error.__class__.__name__, error
+                )
+            )
+            return
 
-    async def execute(self, *args, **kwargs):
-        return await self._query("execute", *args, **kwargs)
+        plan = "\n".join(row[0] for row in rows)
+        query_stats.templates[template].plan = plan
+        log.warning("Plan for slow query {}:\n{}".format(template, plan))
+
+    async def execute(self, *args, transaction=True, **kwargs):
+        return await self._query("execute", *args, transaction=transaction, **kwargs)
 
     async def fetch(self, *args, **kwargs):
         return await self._query("fetch", *args, **kwargs)
@@ -129,13 +635,45 @@ class DB:
     async def fetchval(self, *args, **kwargs):
         return await self._query("fetchval", *args, **kwargs)
 
-    async def upsert(self, table, data):
-        keys = values = ""
-        for num, k in enumerate(data.keys()):
-            if num > 0:
-                keys += ", "
-                values += ", "
-            keys += k
-            values += f"${num}"
-        query = f"INSERT INTO {table} ({keys}) VALUES ({values}) ON CONFLICT DO UPDATE"
-        return await self.execute(query, *data.values())
+    async def copy_records_to_table(self, *args, **kwargs):
+        return await self._query("copy_records_to_table", *args, **kwargs)
+
+    async def copy_from_table(self, *args, **kwargs):
+        return await self._query("copy_from_table", *args, **kwargs)
+
+    async def executemany(self, *args, transaction=True, **kwargs):
+        return await self._query(
+            "executemany", *args, transaction=transaction, **kwargs
+        )
+
+    async def upsert(self, table, rows, conflict_cols, update_cols=None):
+        """Inserts the rows, updating the existing row instead wherever one conflicts on conflict_cols
+
+        rows can be one dict, or a list of dicts that all have the same keys
+        update_cols defaults to every column that isn't a conflict column, if there are none
+        then conflicting rows are left as they are"""
+        if isinstance(rows, dict):
+            rows = [rows]
+        if not rows:
+            return
+
+        columns = list(rows[0].keys())
+        if update_cols is None:
+            update_cols = [c for c in columns if c not in conflict_cols]
+
+        values = ", ".join(f"${num}" for num in range(1, len(columns) + 1))
+        if update_cols:
+            action = "DO UPDATE SET " + ", ".join(
+                f'"{c}" = EXCLUDED."{c}"' for c in update_cols
+            )
+        else:
+            action = "DO NOTHING"
+        query = f"""
+INSERT INTO {table} ({", ".join(f'"{c}"' for c in columns)})
+VALUES ({values})
+ON CONFLICT ({", ".join(f'"{c}"' for c in conflict_cols)}) {action}
+"""
+
+        if len(rows) == 1:
+            return await self.execute(query, *rows[0].values())
+        return await self.executemany(query, [[row[c] for c in columns] for row in rows])
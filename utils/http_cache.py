@@ -0,0 +1,238 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from . import config
+
+log = logging.getLogger()
+
+# The response attributes we know how to store, anything else (such as url) is never cached
+_kinds = ("json", "text", "read")
+
+
+def _size(value):
+    """How many bytes a key or payload takes up, text counts as what it encodes to rather than its length"""
+    if isinstance(value, str):
+        return len(value.encode())
+    return len(value)
+
+
+class _Entry:
+    __slots__ = ("expires", "kind", "payload", "size")
+
+    def __init__(self, expires, kind, payload):
+        # Wall clock time, so an entry spilled to disk still means something after a restart
+        self.expires = expires
+        self.kind = kind
+        # The body as text (or bytes for read), so every hit gets its own copy to do what it wants with
+        self.payload = payload
+        self.size = 0
+
+    @property
+    def value(self):
+        if self.payload is None or self.kind != "json":
+            return self.payload
+        return json.loads(self.payload)
+
+    def to_json(self):
+        payload = self.payload
+        if isinstance(payload, bytes):
+            payload = base64.b64encode(payload).decode()
+        return {
+            "expires": self.expires,
+            "kind": self.kind,
+            "payload": payload,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        payload = data["payload"]
+        if data["kind"] == "read" and payload is not None:
+            payload = base64.b64decode(payload)
+        return cls(data["expires"], data["kind"], payload)
+
+
+class ResponseCache:
+    """Remembers responses for the endpoints that have a TTL, in an LRU bounded by the size of the bodies
+
+    Empty responses (not found, or an empty result) are remembered too, but for less time. If a directory
+    is set, whatever gets evicted (as well as everything left on shutdown) is spilled to it, and is
+    looked up there before going to the site"""
+
+    def __init__(self, *, max_bytes=None, directory=None, ttls=None):
+        self.max_bytes = max_bytes or config.http_cache_max_bytes
+        self.directory = directory or config.http_cache_dir
+        # Host, or host and the start of the path -> how long (in seconds) its responses are good for
+        self.ttls = ttls if ttls is not None else config.http_cache_ttls
+        self.negative_ttl = config.http_cache_negative_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        # Where each lookup was answered from since startup, for the httpcache command
+        self.hits = 0
+        self.negative_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(method, url, params, json_data, attr, headers=None):
+        params = sorted((params or {}).items())
+        body = json.dumps(json_data, sort_keys=True) if json_data is not None else ""
+        # Headers such as auth or Accept can change the response, so they have to match too
+        headers = sorted((headers or {}).items())
+        return f"{method} {url} {params} {body} {attr} {headers}"
+
+    def ttl(self, url, attr):
+        """How long this response can be cached for, None if it shouldn't be"""
+        if attr not in _kinds or not self.ttls:
+            return None
+        parts = urlsplit(url)
+        target = (parts.hostname or "") + parts.path
+        matches = [e for e in self.ttls if target.startswith(e)]
+        if not matches:
+            return None
+        return self.ttls[max(matches, key=len)]
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json"
+        )
+
+    async def get(self, key):
+        """Returns (found, value), value can be None if the site had nothing for this"""
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires <= time.time():
+            self._remove(key)
+            entry = None
+        if entry is None and self.directory:
+            entry = await self._read(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._add(key, entry)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        value = entry.value
+        if value:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return True, value
+
+    def set(self, key, value, attr, ttl):
+        # Empty results aren't likely to change soon, but could do sooner than a real one would
+        if not value:
+            ttl = min(ttl, self.negative_ttl)
+        if value is None:
+            payload = None
+        elif attr == "json":
+            payload = json.dumps(value)
+        else:
+            payload = value
+        # Something that would push everything else out isn't worth keeping
+        if payload is not None and _size(payload) > self.max_bytes // 4:
+            return
+        self._add(key, _Entry(time.time() + ttl, attr, payload))
+
+    def _add(self, key, entry):
+        self._remove(key)
+        # The key counts too, otherwise empty responses would never take up any room
+        entry.size = _size(key)
+        if entry.payload is not None:
+            entry.size += _size(entry.payload)
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes and self.entries:
+            old_key, old = self.entries.popitem(last=False)
+            self.size -= old.size
+            self.evictions += 1
+            if self.directory and old.expires > time.time():
+                asyncio.get_event_loop().create_task(self._write(old_key, old))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    async def _read(self, key):
+        path = self._path(key)
+
+        def read():
+            try:
+                with open(path) as f:
+                    return _Entry.from_json(json.load(f))
+            except (OSError, ValueError, KeyError):
+                return None
+
+        entry = await asyncio.get_event_loop().run_in_executor(None, read)
+        if entry is None:
+            return None
+        # It's either back in memory now or expired, either way it doesn't need to be on disk
+        await asyncio.get_event_loop().run_in_executor(None, self._unlink, path)
+        if entry.expires <= time.time():
+            return None
+        return entry
+
+    async def _write(self, key, entry):
+        path = self._path(key)
+
+        def write():
+            os.makedirs(self.directory, exist_ok=True)
+            # Written to the side first, so a reader never sees half a file
+            with open(path + ".partial", "w") as f:
+                json.dump(entry.to_json(), f)
+            os.replace(path + ".partial", path)
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, write)
+        except OSError as error:
+            log.warning(
+                "Failed to spill cached response to disk: {}: {}".format(
+                    error.__class__.__name__, error
+                )
+            )
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Removes the spilled files old enough that they must have expired"""
+        oldest = time.time() - max(self.ttls.values(), default=0)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    async def close(self):
+        """Spills everything still fresh to disk, so it's there after a restart"""
+        if not self.directory:
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self._prune)
+        now = time.time()
+        await asyncio.gather(
+            *(
+                self._write(key, entry)
+                for key, entry in self.entries.items()
+                if entry.expires > now
+            )
+        )
@@ -0,0 +1,234 @@
+import asyncio
+import copy
+import datetime
+import email.utils
+import random
+import time
+
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from . import config
+from .http_cache import ResponseCache
+
+
+class RetryPolicy:
+    """How a request to some site is retried: which statuses, how long to wait between, and for how long overall"""
+
+    __slots__ = ("attempts", "statuses", "backoff", "max_backoff", "deadline")
+
+    def __init__(
+        self,
+        *,
+        attempts=None,
+        statuses=None,
+        backoff=None,
+        max_backoff=None,
+        deadline=None,
+    ):
+        self.attempts = attempts or config.http_retry_attempts
+        self.statuses = frozenset(statuses or config.http_retry_statuses)
+        self.backoff = backoff if backoff is not None else config.http_retry_backoff
+        self.max_backoff = (
+            max_backoff if max_backoff is not None else config.http_retry_max_backoff
+        )
+        self.deadline = deadline or config.http_retry_deadline
+
+    def delay(self, attempt, retry_after=None):
+        """How long to wait before the next attempt, attempt being how many have been made so far"""
+        # If the site told us how long to wait, that's the least we wait
+        if retry_after is not None:
+            return retry_after
+        # Full jitter, so everything that failed at once doesn't all retry at once too
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """Retry-After is either a number of seconds or a date, returns the seconds until then"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+
+class CircuitBreaker:
+    """Stops requests to a host after it's failed enough times in a row, so commands using it fail fast
+
+    After the reset timeout one request is let through to see if it's back, if that works we close again"""
+
+    closed = "closed"
+    open = "open"
+    half_open = "half open"
+
+    def __init__(self, host, *, threshold=None, reset_timeout=None):
+        self.host = host
+        self.threshold = threshold or config.http_breaker_threshold
+        self.reset_timeout = reset_timeout or config.http_breaker_reset
+        self.failures = 0
+        self.opened = None
+        self._probe = None
+        # Totals for this host since startup, as opposed to failures which is only the current streak
+        self.successes = 0
+        self.total_failures = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return self.closed
+        if time.monotonic() - self.opened < self.reset_timeout:
+            return self.open
+        return self.half_open
+
+    def allow(self):
+        state = self.state
+        if state == self.closed:
+            return True
+        now = time.monotonic()
+        # Only one request at a time gets to check if the host is back. If that one never reports back
+        # (such as being cancelled), another is let through after the timeout again
+        if state == self.half_open and (
+            self._probe is None or now - self._probe >= self.reset_timeout
+        ):
+            self._probe = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.successes += 1
+        self.failures = 0
+        self.opened = None
+        self._probe = None
+
+    def failure(self):
+        self.total_failures += 1
+        self.failures += 1
+        self._probe = None
+        # A failed check opens it straight back up, otherwise wait until we've hit the threshold
+        if self.opened is not None or self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs one call per key at a time, anything asking for the same key while it's running shares the result
+
+    The call runs in its own task, so one of the callers being cancelled doesn't cancel it for the others.
+    Only once every caller has given up is the call itself cancelled"""
+
+    def __init__(self):
+        self.flights = {}
+        # Calls that actually ran, and callers that got another's result instead
+        self.started = 0
+        self.shared = 0
+
+    async def run(self, key, call, timeout):
+        """Awaits call() or the identical call already running, raising asyncio.TimeoutError after timeout"""
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self.flights[key] = _Flight(
+                asyncio.ensure_future(asyncio.wait_for(call(), timeout))
+            )
+            flight.task.add_done_callback(lambda _: self._finished(key, flight))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                # Nobody wants it anymore, anyone asking from now on will start their own
+                self._finished(key, flight)
+                flight.task.cancel()
+            raise
+        # Everyone shares the result, the first caller included, so each gets their own copy to change
+        return copy.deepcopy(result)
+
+    def _finished(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+
+class HTTPClient:
+    """The one aiohttp session everything shares, so connections (and their TLS handshakes) get reused
+
+    The session is only created the first time it's used, as aiohttp wants one created inside the event loop"""
+
+    def __init__(
+        self, *, limit=None, limit_per_host=None, dns_cache_ttl=None, keepalive=None
+    ):
+        self.limit = limit or config.http_connection_limit
+        self.limit_per_host = limit_per_host or config.http_connection_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl or config.http_dns_cache_ttl
+        self.keepalive = keepalive or config.http_keepalive_timeout
+        self._session = None
+        self.breakers = {}
+        # Host, or host and the start of the path -> the RetryPolicy for requests to it
+        self.policies = {
+            endpoint: RetryPolicy(**options)
+            for endpoint, options in config.http_retry_policies.items()
+        }
+        self.default_policy = RetryPolicy()
+        self.cache = ResponseCache()
+        self.flights = SingleFlight()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                # So one slow site can't take every connection from the rest
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def breaker(self, url):
+        host = urlsplit(url).hostname
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host)
+        return self.breakers[host]
+
+    def policy(self, url):
+        """The retry policy for this url, the most specific endpoint it matches or the default"""
+        parts = urlsplit(url)
+        target = (parts.hostname or "") + parts.path
+        matches = [e for e in self.policies if target.startswith(e)]
+        if not matches:
+            return self.default_policy
+        return self.policies[max(matches, key=len)]
+
+    async def close(self):
+        await self.cache.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+http = HTTPClient()
@@ -46,7 +46,13 @@ async def create_banner(member, image_title, data):
 
     # This is the background to the avatar
     mask = Image.open('{}/mask.png'.format(base_path)).convert('L')
-    user_avatar = Image.open(avatar)
+    # If we couldn't get their avatar, leave a gap where it would have been
+    if avatar is None:
+        user_avatar = Image.new("RGBA", mask.size)
+    else:
+        with avatar:
+            user_avatar = Image.open(avatar)
+            user_avatar.load()
     output = ImageOps.fit(user_avatar, mask.size, centering=(0.5, 0.5))
     output.putalpha(mask)
 
@@ -0,0 +1,316 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import os
+import time
+
+from discord.ext import commands
+
+from . import config
+from .checks import can_run
+from .metrics import timings
+
+log = logging.getLogger()
+
+manifest_path = os.path.join(os.path.dirname(__file__), "extension_manifest.json")
+
+
+class LazyCommand(commands.Command):
+    """A placeholder for a command whose extension hasn't been loaded yet"""
+
+    def __init__(self, func, **kwargs):
+        super().__init__(func, **kwargs)
+        self.extension = kwargs.get("extension")
+
+
+class LazyGroup(commands.Group):
+    """A placeholder for a group whose extension hasn't been loaded yet"""
+
+    def __init__(self, func, **kwargs):
+        super().__init__(func, **kwargs)
+        self.extension = kwargs.get("extension")
+
+
+async def _stub_callback(self, ctx):
+    # The bot loads the real extension before this would ever be invoked
+    pass
+
+
+# The checks a placeholder can copy, by the name of the function that made them -> how to make it again
+_checks = {
+    "can_run": lambda perms: can_run(**perms),
+    "guild_only": lambda _: commands.guild_only(),
+    "dm_only": lambda _: commands.dm_only(),
+    "is_owner": lambda _: commands.is_owner(),
+    "is_nsfw": lambda _: commands.is_nsfw(),
+    "has_permissions": lambda perms: commands.has_permissions(**perms),
+    "bot_has_permissions": lambda perms: commands.bot_has_permissions(**perms),
+    "has_guild_permissions": lambda perms: commands.has_guild_permissions(**perms),
+}
+
+
+def _describe_check(check):
+    """Returns [kind, perms] for the check, kind is None if it's not one a placeholder can copy"""
+    kind = check.__qualname__.split(".<locals>")[0]
+    if kind not in _checks:
+        return [None, check.__qualname__]
+    # can_run keeps its permissions on the check, the discord.py ones close over them
+    perms = getattr(check, "perms", None)
+    if perms is None:
+        perms = inspect.getclosurevars(check).nonlocals.get("perms")
+    return [kind, perms]
+
+
+def _unsupported_checks(data):
+    """The checks in this extension's manifest entry that its placeholders couldn't copy"""
+    unsupported = []
+
+    def walk(command):
+        for kind, detail in command["checks"]:
+            if kind is None:
+                unsupported.append(f"{command['name']} ({detail})")
+        for sub in command["commands"]:
+            walk(sub)
+
+    for cog in data["cogs"]:
+        if cog["cog_check"]:
+            unsupported.append(f"{cog['name']} (cog_check)")
+        for command in cog["commands"]:
+            walk(command)
+    return unsupported
+
+
+def _build_command(extension, data):
+    kwargs = {
+        "name": data["name"],
+        "aliases": data["aliases"],
+        "help": data["help"],
+        "brief": data["brief"],
+        "usage": data["usage"],
+        "hidden": data["hidden"],
+        "ignore_extra": True,
+        "extension": extension,
+    }
+    # Use the same checks, so help and can_run treat the placeholder the same as the real command
+    kwargs["checks"] = [_checks[kind](perms).predicate for kind, perms in data["checks"]]
+
+    if not data["commands"]:
+        return LazyCommand(_stub_callback, **kwargs)
+
+    command = LazyGroup(_stub_callback, invoke_without_command=True, **kwargs)
+    for sub in data["commands"]:
+        command.add_command(_build_command(extension, sub))
+    return command
+
+
+def _describe_command(command):
+    return {
+        "name": command.name,
+        "aliases": list(command.aliases),
+        "help": command.help,
+        "brief": command.brief,
+        "usage": command.usage or command.signature,
+        "hidden": command.hidden,
+        "checks": [_describe_check(check) for check in command.checks],
+        "commands": [
+            _describe_command(c) for c in getattr(command, "commands", [])
+        ],
+    }
+
+
+def generate_manifest(bot, extensions):
+    """Loads each extension to describe its cogs, commands and listeners"""
+    manifest = {}
+    for extension in extensions:
+        bot.load_extension(extension)
+        cogs = [cog for cog in bot.cogs.values() if cog.__module__ == extension]
+        manifest[extension] = {
+            "cogs": [
+                {
+                    "name": cog.qualified_name,
+                    "description": cog.description,
+                    # Whatever a cog checks for all its commands can't be copied onto placeholders
+                    "cog_check": type(cog).cog_check is not commands.Cog.cog_check,
+                    "commands": [_describe_command(c) for c in cog.get_commands()],
+                }
+                for cog in cogs
+            ],
+            "listeners": sorted(
+                {name for cog in cogs for name, _ in cog.get_listeners()}
+            ),
+        }
+        bot.unload_extension(extension)
+    return manifest
+
+
+class LazyExtensions:
+    """Registers placeholder cogs for extensions, only loading the real ones once they're needed"""
+
+    def __init__(self, bot, *, extensions=None, unload_after=None):
+        self.bot = bot
+        self.lazy = set(extensions if extensions is not None else config.lazy_extensions)
+        self.unload_after = unload_after or config.lazy_unload_after
+        # Extension -> the placeholder cogs and listeners registered for it
+        self.stubs = {}
+        # Extension -> the last time one of its commands was used
+        self.last_used = {}
+        self._task = None
+
+        self.manifest = {}
+        if not self.lazy:
+            return
+        try:
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            raise RuntimeError(
+                "lazy_extensions is set, but there's no extension manifest. "
+                "Run `python -m utils.lazy` to generate one"
+            ) from None
+        missing = sorted(self.lazy - set(self.manifest))
+        if missing:
+            raise RuntimeError(
+                "These lazy_extensions aren't in the extension manifest: {}. "
+                "Run `python -m utils.lazy` to regenerate it".format(", ".join(missing))
+            )
+        unsupported = {
+            extension: _unsupported_checks(self.manifest[extension])
+            for extension in sorted(self.lazy)
+        }
+        unsupported = {e: checks for e, checks in unsupported.items() if checks}
+        if unsupported:
+            raise RuntimeError(
+                "These lazy_extensions have checks their placeholders can't copy, so they have to be loaded "
+                "normally: {}".format(
+                    "; ".join(f"{e}: {', '.join(c)}" for e, c in unsupported.items())
+                )
+            )
+
+    def register(self, extension):
+        """Registers placeholders for this extension, returns False if it needs to be loaded now instead"""
+        if extension not in self.lazy:
+            return False
+
+        data = self.manifest[extension]
+        cogs = []
+        for cog_data in data["cogs"]:
+            namespace = {"__doc__": cog_data["description"]}
+            for num, command_data in enumerate(cog_data["commands"]):
+                namespace[f"_command_{num}"] = _build_command(extension, command_data)
+            cog = commands.CogMeta(
+                cog_data["name"], (commands.Cog,), namespace, name=cog_data["name"]
+            )()
+            self.bot.add_cog(cog)
+            cogs.append(cog)
+
+        listeners = []
+        for event in data["listeners"]:
+            listener = self._make_listener(extension, event)
+            self.bot.add_listener(listener, event)
+            listeners.append((listener, event))
+
+        self.stubs[extension] = (cogs, listeners)
+        return True
+
+    def load(self, extension):
+        """Loads the real extension, replacing its placeholders if they're registered"""
+        stubs = self.stubs.pop(extension, None)
+        if stubs is not None:
+            cogs, listeners = stubs
+            for cog in cogs:
+                self.bot.remove_cog(cog.qualified_name)
+            for listener, event in listeners:
+                self.bot.remove_listener(listener, event)
+
+        with timings.timer("lazy load"):
+            try:
+                # Loading can start tasks, such as a cog's tasks.loop. Those would otherwise inherit the command
+                # that caused the load's context (its db session, replica pin and timings) for as long as they run
+                contextvars.Context().run(self.bot.load_extension, extension)
+            except Exception:
+                # Put the placeholders back so the next use can try again
+                if stubs is not None:
+                    self.register(extension)
+                raise
+        self.last_used[extension] = time.monotonic()
+
+    def touch(self, command):
+        if command.module in self.lazy:
+            self.last_used[command.module] = time.monotonic()
+
+    def _make_listener(self, extension, event):
+        async def listener(*args, **kwargs):
+            if extension not in self.bot.extensions:
+                self.load(extension)
+            # The real listeners weren't registered when this event was dispatched, so pass it along
+            for cog in list(self.bot.cogs.values()):
+                if cog.__module__ != extension:
+                    continue
+                for name, method in cog.get_listeners():
+                    if name == event:
+                        await method(*args, **kwargs)
+
+        return listener
+
+    def in_use(self, extension):
+        """Whether any of the extension's cogs are holding on to something, such as a game in progress"""
+        for cog in self.bot.cogs.values():
+            if cog.__module__ == extension and getattr(cog, "in_use", lambda: False)():
+                return True
+        return False
+
+    def start(self):
+        if self.unload_after and self._task is None:
+            self._task = self.bot.loop.create_task(self._unload_idle())
+
+    async def _unload_idle(self):
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            for extension, last_used in list(self.last_used.items()):
+                # We can't put placeholders back without a manifest entry, and extensions
+                # with listeners are in use whenever those fire, so leave those loaded
+                if extension not in self.manifest or self.manifest[extension]["listeners"]:
+                    continue
+                if extension in self.stubs or now - last_used < self.unload_after:
+                    continue
+                # Unloading would throw away whatever is going on, so wait until it's over
+                if self.in_use(extension):
+                    continue
+
+                self.bot.unload_extension(extension)
+                del self.last_used[extension]
+                self.register(extension)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Generates the extension manifest used by lazy_extensions"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only check that the manifest is up to date with the extensions, instead of writing it",
+    )
+    args = parser.parse_args()
+
+    # This needs to be redone whenever commands change, --check can be used to catch when it hasn't been
+    _bot = commands.Bot(command_prefix=config.default_prefix)
+    _manifest = generate_manifest(_bot, config.extensions)
+    if args.check:
+        try:
+            with open(manifest_path) as f:
+                _current = json.load(f)
+        except FileNotFoundError:
+            _current = None
+        if _current != _manifest:
+            print("The extension manifest is out of date, run `python -m utils.lazy`")
+            raise SystemExit(1)
+        print("The extension manifest is up to date")
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(_manifest, f, indent=4)
@@ -0,0 +1,234 @@
+import contextvars
+import functools
+import logging
+import math
+import re
+import time
+
+from collections import defaultdict
+
+from aiohttp import web
+
+log = logging.getLogger()
+
+
+class Histogram:
+    """A log bucketed histogram (in the style of HDR histograms), percentiles are accurate to within ~5%"""
+
+    # How many buckets each power of two is split into
+    precision = 16
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # Bucket on microseconds, anything under one just goes in the first bucket
+        micros = seconds * 1000000
+        bucket = int(math.log2(micros) * self.precision) if micros > 1 else 0
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                # Use the upper bound of the bucket, but never report more than we've actually seen
+                return min(2 ** ((bucket + 1) / self.precision) / 1000000, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class _Timer:
+    __slots__ = ("timings", "phase", "start")
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.observe(self.phase, time.perf_counter() - self.start)
+
+
+class Timings:
+    """Holds latency histograms for every (command, phase) pair"""
+
+    quantiles = (50, 95, 99)
+
+    def __init__(self):
+        # (command, phase) -> Histogram
+        self.histograms = defaultdict(Histogram)
+        # The command being ran in the current task, anything else is recorded as background work
+        self.command = contextvars.ContextVar("command", default=None)
+
+    def observe(self, phase, seconds, command=None):
+        command = command or self.command.get() or "background"
+        self.histograms[(command, phase)].record(seconds)
+
+    def timer(self, phase):
+        """A context manager that records how long its body took under this phase"""
+        return _Timer(self, phase)
+
+    def slowest_commands(self, amount=10, percent=95):
+        """Returns (command, histogram) for the commands with the highest total latency"""
+        totals = [
+            (command, histogram)
+            for (command, phase), histogram in self.histograms.items()
+            if phase == "total"
+        ]
+        totals.sort(key=lambda t: t[1].percentile(percent), reverse=True)
+        return totals[:amount]
+
+    def slowest_phases(self, amount=10, percent=95):
+        """Returns (phase, histogram) for each phase across every command, slowest first"""
+        phases = defaultdict(Histogram)
+        for (command, phase), histogram in self.histograms.items():
+            if phase != "total":
+                phases[phase].merge(histogram)
+        phases = sorted(
+            phases.items(), key=lambda t: t[1].percentile(percent), reverse=True
+        )
+        return phases[:amount]
+
+    def prometheus(self):
+        """Renders all histograms in the Prometheus text format"""
+        lines = [
+            "# HELP bonfire_latency_seconds Time spent per command and phase",
+            "# TYPE bonfire_latency_seconds summary",
+        ]
+        for (command, phase), histogram in sorted(self.histograms.items()):
+            labels = f'command="{command}",phase="{phase}"'
+            for q in self.quantiles:
+                lines.append(
+                    f'bonfire_latency_seconds{{{labels},quantile="{q / 100}"}} '
+                    f"{histogram.percentile(q)}"
+                )
+            lines.append(f"bonfire_latency_seconds_sum{{{labels}}} {histogram.total}")
+            lines.append(f"bonfire_latency_seconds_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Serves the Prometheus text on /metrics, only bound locally by default"""
+
+        async def handler(_):
+            return web.Response(text=self.prometheus())
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+# Numbers and quoted strings written straight into a query, but not the $1 style parameters
+_literals = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?\b")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_query(query):
+    """Collapses a query down to its template, so the same query with different literals is counted together"""
+    return " ".join(_literals.sub("?", query).split())
+
+
+class QueryTemplate:
+    __slots__ = ("latency", "rows", "wait", "plan")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        # Time spent waiting on the pool for a connection, rather than running the query
+        self.wait = 0.0
+        # The output of the last EXPLAIN ran on this when it was slow, if any
+        self.plan = None
+
+
+class QueryStats:
+    """Holds stats for every query template ran"""
+
+    sort_keys = {
+        "total": lambda t: t.latency.total,
+        "mean": lambda t: t.latency.mean,
+        "max": lambda t: t.latency.max,
+        "count": lambda t: t.latency.count,
+        "rows": lambda t: t.rows,
+        "wait": lambda t: t.wait,
+    }
+
+    def __init__(self):
+        # Normalized query -> QueryTemplate
+        self.templates = defaultdict(QueryTemplate)
+
+    def observe(self, query, seconds, wait, rows):
+        """Records one run of this query, returning the template it was counted under"""
+        template = normalize_query(query)
+        stats = self.templates[template]
+        stats.latency.record(seconds)
+        stats.wait += wait
+        stats.rows += rows
+        return template
+
+    def slowest(self, amount=10, key="total"):
+        """Returns (template, stats) for the worst templates by the given key"""
+        sort_key = self.sort_keys[key]
+        templates = sorted(
+            self.templates.items(), key=lambda t: sort_key(t[1]), reverse=True
+        )
+        return templates[:amount]
+
+
+class StartupTimings:
+    """Records how long each step of starting the bot up took, so cold starts can be compared"""
+
+    def __init__(self):
+        # Step name -> seconds, in the order they finished
+        self.times = {}
+
+    def observe(self, step, seconds):
+        self.times[step] = seconds
+        log.info("Startup: {} took {:.3f}s".format(step, seconds))
+
+    def timer(self, step):
+        return _Timer(self, step)
+
+    def report(self):
+        lines = [
+            f"{step:<35} {seconds * 1000:>8.0f}ms"
+            for step, seconds in sorted(
+                self.times.items(), key=lambda t: t[1], reverse=True
+            )
+        ]
+        # The cache loads overlap, so this is more than the wall clock time
+        lines.append(f"{'Sum':<35} {sum(self.times.values()) * 1000:>8.0f}ms")
+        return "\n".join(lines)
+
+
+timings = Timings()
+query_stats = QueryStats()
+startup = StartupTimings()
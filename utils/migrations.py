@@ -0,0 +1,498 @@
+import asyncio
+import datetime
+import json
+import logging
+
+from . import config
+
+log = logging.getLogger()
+
+# Held while migrating, so clusters starting at the same time don't all try to apply the same migrations
+advisory_lock = 0x626F6E66
+
+
+class Migration:
+    __slots__ = ("version", "description", "sql")
+
+    def __init__(self, version, description, sql):
+        self.version = version
+        self.description = description
+        self.sql = sql
+
+
+# These are applied in order, and each only once. Never change one that's been released, add a new one instead
+migrations = [
+    Migration(
+        1,
+        "Create the tables",
+        """
+CREATE TABLE IF NOT EXISTS guilds (
+    id bigint PRIMARY KEY,
+    prefix text,
+    birthday_notifications boolean DEFAULT false,
+    welcome_notifications boolean DEFAULT false,
+    goodbye_notifications boolean DEFAULT false,
+    colour_roles boolean DEFAULT false,
+    include_default_battles boolean DEFAULT true,
+    include_default_hugs boolean DEFAULT true,
+    welcome_msg text,
+    goodbye_msg text,
+    default_alerts bigint,
+    welcome_alerts bigint,
+    goodbye_alerts bigint,
+    picarto_alerts bigint,
+    birthday_alerts bigint,
+    raffle_alerts bigint,
+    join_role bigint,
+    followed_picarto_channels text[] DEFAULT '{}',
+    ignored_channels bigint[] DEFAULT '{}',
+    ignored_members bigint[] DEFAULT '{}',
+    rules text[] DEFAULT '{}',
+    assignable_roles bigint[] DEFAULT '{}',
+    custom_battles text[] DEFAULT '{}',
+    custom_hugs text[] DEFAULT '{}'
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id bigint PRIMARY KEY,
+    birthday date,
+    osu text,
+    battle_rating integer,
+    battle_wins integer DEFAULT 0,
+    battle_losses integer DEFAULT 0,
+    tictactoe_rating integer,
+    tictactoe_wins integer DEFAULT 0,
+    tictactoe_losses integer DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+    id serial PRIMARY KEY,
+    guild bigint NOT NULL,
+    creator bigint NOT NULL,
+    trigger text NOT NULL,
+    result text NOT NULL,
+    uses integer DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS boops (
+    booper bigint,
+    boopee bigint,
+    amount integer DEFAULT 0,
+    PRIMARY KEY (booper, boopee)
+);
+
+CREATE TABLE IF NOT EXISTS restrictions (
+    guild bigint,
+    source text,
+    destination text,
+    from_to text,
+    PRIMARY KEY (guild, source, destination, from_to)
+);
+
+CREATE TABLE IF NOT EXISTS custom_permissions (
+    guild bigint,
+    command text,
+    permission bigint,
+    PRIMARY KEY (guild, command)
+);
+
+CREATE TABLE IF NOT EXISTS command_usage (
+    command text,
+    guild bigint,
+    author bigint,
+    executed timestamp
+);
+""",
+    ),
+    Migration(
+        2,
+        "Index the columns the cogs look things up by",
+        """
+-- !tag, and everything else looking a tag up by its trigger, as well as listing a guild's tags
+CREATE INDEX IF NOT EXISTS tags_guild_trigger ON tags (guild, trigger);
+-- !mytags
+CREATE INDEX IF NOT EXISTS tags_guild_creator ON tags (guild, creator);
+-- Ranking everyone that has battled
+CREATE INDEX IF NOT EXISTS users_battle_rating ON users (battle_rating DESC)
+    WHERE battle_rating IS NOT NULL;
+-- Loading everyone's osu account on startup
+CREATE INDEX IF NOT EXISTS users_osu ON users (id) WHERE osu IS NOT NULL;
+""",
+    ),
+    Migration(
+        3,
+        "Roll command_usage up per day, for guilds and authors",
+        """
+CREATE TABLE command_usage_guild_daily (
+    guild bigint,
+    command text,
+    day date,
+    uses bigint NOT NULL,
+    first_used timestamp NOT NULL,
+    PRIMARY KEY (guild, command, day)
+);
+
+CREATE TABLE command_usage_author_daily (
+    author bigint,
+    command text,
+    day date,
+    uses bigint NOT NULL,
+    first_used timestamp NOT NULL,
+    PRIMARY KEY (author, command, day)
+);
+
+-- The trigger rolls up anything executed from backfill_until onwards, the backfill does everything before it
+-- backfilled_to is how far the backfill has gotten, so it can carry on from there if it's interrupted
+CREATE TABLE command_usage_rollup_state (
+    backfill_until timestamp NOT NULL,
+    backfilled_to timestamp
+);
+INSERT INTO command_usage_rollup_state (backfill_until) VALUES (now() AT TIME ZONE 'utc');
+
+CREATE FUNCTION command_usage_rollup() RETURNS trigger AS $$
+DECLARE
+    since timestamp;
+BEGIN
+    SELECT backfill_until INTO since FROM command_usage_rollup_state;
+
+    INSERT INTO command_usage_guild_daily (guild, command, day, uses, first_used)
+    SELECT guild, command, executed::date, COUNT(*), MIN(executed)
+    FROM new_rows
+    WHERE guild IS NOT NULL AND executed >= since
+    GROUP BY guild, command, executed::date
+    ON CONFLICT (guild, command, day) DO UPDATE SET
+        uses = command_usage_guild_daily.uses + EXCLUDED.uses,
+        first_used = LEAST(command_usage_guild_daily.first_used, EXCLUDED.first_used);
+
+    INSERT INTO command_usage_author_daily (author, command, day, uses, first_used)
+    SELECT author, command, executed::date, COUNT(*), MIN(executed)
+    FROM new_rows
+    WHERE executed >= since
+    GROUP BY author, command, executed::date
+    ON CONFLICT (author, command, day) DO UPDATE SET
+        uses = command_usage_author_daily.uses + EXCLUDED.uses,
+        first_used = LEAST(command_usage_author_daily.first_used, EXCLUDED.first_used);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Usage is written with COPY in batches, so roll up each batch at once rather than row by row
+CREATE TRIGGER command_usage_rollup
+    AFTER INSERT ON command_usage
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE command_usage_rollup();
+
+-- Stats read the rollups, the only thing reading command_usage itself is the backfill, by time
+CREATE INDEX command_usage_executed ON command_usage USING brin (executed);
+""",
+    ),
+    Migration(
+        4,
+        "Constrain command_usage to what will be its first partition",
+        """
+-- Usage used to be logged without a time, so every row from before the batched recorder has none.
+-- The old stats counted them with COUNT(*), but none of them can go in a partition as they are,
+-- and neither the trigger nor the backfill rolls them up. Rather than lose them, they're dated just
+-- before the backfill's cutoff, so they're counted in the rollups as usage from before that day
+WITH untimed AS (
+    UPDATE command_usage
+    SET executed = (SELECT backfill_until FROM command_usage_rollup_state) - interval '1 microsecond'
+    WHERE executed IS NULL
+    RETURNING command, guild, author, executed
+),
+-- If the backfill already finished it won't see them, so roll them up here instead
+finished AS (
+    SELECT 1 FROM command_usage_rollup_state WHERE backfilled_to >= backfill_until
+),
+guild_rollup AS (
+    INSERT INTO command_usage_guild_daily (guild, command, day, uses, first_used)
+    SELECT guild, command, executed::date, COUNT(*), MIN(executed)
+    FROM untimed
+    WHERE guild IS NOT NULL AND EXISTS (SELECT 1 FROM finished)
+    GROUP BY guild, command, executed::date
+    ON CONFLICT (guild, command, day) DO UPDATE SET
+        uses = command_usage_guild_daily.uses + EXCLUDED.uses,
+        first_used = LEAST(command_usage_guild_daily.first_used, EXCLUDED.first_used)
+)
+INSERT INTO command_usage_author_daily (author, command, day, uses, first_used)
+SELECT author, command, executed::date, COUNT(*), MIN(executed)
+FROM untimed
+WHERE EXISTS (SELECT 1 FROM finished)
+GROUP BY author, command, executed::date
+ON CONFLICT (author, command, day) DO UPDATE SET
+    uses = command_usage_author_daily.uses + EXCLUDED.uses,
+    first_used = LEAST(command_usage_author_daily.first_used, EXCLUDED.first_used);
+
+-- Attaching a table as a partition scans all of it while holding a lock that blocks logging usage,
+-- unless a valid constraint already proves every row fits. NOT VALID adds it without the scan,
+-- the next migration checks the existing rows without blocking writes. Every existing row has a time
+-- before the bound by now, so this changes nothing for them, it only rejects new rows without one
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE command_usage ADD CONSTRAINT command_usage_legacy_bound CHECK (executed IS NOT NULL AND executed < %L) NOT VALID',
+        date_trunc('month', now() AT TIME ZONE 'utc') + interval '1 month'
+    );
+END
+$$;
+""",
+    ),
+    Migration(
+        5,
+        "Validate the command_usage constraint",
+        """
+-- Its own transaction, so nothing holds a stronger lock while this scans the table
+ALTER TABLE command_usage VALIDATE CONSTRAINT command_usage_legacy_bound;
+""",
+    ),
+    Migration(
+        6,
+        "Partition command_usage by month",
+        """
+-- The first migration only creates command_usage if it didn't exist, so one made before migrations
+-- could have different columns. Attaching it would fail with nothing to say why, so check first
+DO $$
+DECLARE
+    found text;
+BEGIN
+    SELECT string_agg(attname || ' ' || format_type(atttypid, atttypmod), ', ' ORDER BY attname)
+    INTO found
+    FROM pg_attribute
+    WHERE attrelid = 'command_usage'::regclass AND attnum > 0 AND NOT attisdropped;
+
+    IF found IS DISTINCT FROM 'author bigint, command text, executed timestamp without time zone, guild bigint' THEN
+        RAISE EXCEPTION 'command_usage has the columns (%), it needs exactly (command text, guild bigint, author bigint, executed timestamp) to be partitioned. Alter it to match, then migrate again', found;
+    END IF;
+END
+$$;
+
+DROP TRIGGER command_usage_rollup ON command_usage;
+DROP INDEX command_usage_executed;
+ALTER TABLE command_usage RENAME TO command_usage_legacy;
+
+CREATE TABLE command_usage (
+    command text,
+    guild bigint,
+    author bigint,
+    executed timestamp
+) PARTITION BY RANGE (executed);
+
+-- Everything logged so far stays where it is, as one partition up until next month
+-- utils.usage.create_partitions makes the monthly ones from there
+-- The constraint is the same bound (or an earlier one, if a month started in between), so this doesn't scan
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE command_usage ATTACH PARTITION command_usage_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        date_trunc('month', now() AT TIME ZONE 'utc') + interval '1 month'
+    );
+END
+$$;
+-- The partition's bound does the same job now
+ALTER TABLE command_usage_legacy DROP CONSTRAINT command_usage_legacy_bound;
+
+-- Both of these apply to every partition
+CREATE INDEX command_usage_executed ON command_usage USING brin (executed);
+CREATE TRIGGER command_usage_rollup
+    AFTER INSERT ON command_usage
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE command_usage_rollup();
+""",
+    ),
+    Migration(
+        7,
+        "Add command_analytics",
+        """
+-- The sketches utils.analytics.Analytics keeps in memory, saved so they survive restarts
+CREATE TABLE command_analytics (
+    cluster integer PRIMARY KEY,
+    data bytea NOT NULL
+);
+""",
+    ),
+    Migration(
+        8,
+        "Index the guilds the background loops notify",
+        """
+-- The daily birthday announcements
+CREATE INDEX IF NOT EXISTS guilds_birthday_alerts ON guilds (id)
+    WHERE birthday_notifications=True AND COALESCE(birthday_alerts, default_alerts) IS NOT NULL;
+-- Checking who's gone live on picarto, every 30 seconds
+CREATE INDEX IF NOT EXISTS guilds_picarto_alerts ON guilds (id)
+    WHERE COALESCE(picarto_alerts, default_alerts) IS NOT NULL;
+""",
+    ),
+]
+
+# Every query the cogs make against a table that grows, with example arguments. This is kept by hand,
+# so a query that isn't added here is never checked. Add to it along with any new query
+checked_queries = [
+    ("SELECT id, result FROM tags WHERE guild=$1 AND trigger=$2", (1, "trigger")),
+    ("SELECT trigger FROM tags WHERE guild=$1 AND creator=$2", (1, 1)),
+    ("SELECT trigger FROM tags WHERE guild=$1", (1,)),
+    ("SELECT amount FROM boops WHERE booper = $1 AND boopee = $2", (1, 1)),
+    (
+        "SELECT boopee, amount FROM boops WHERE booper=$1 AND boopee = ANY($2) "
+        "ORDER BY amount DESC LIMIT 10",
+        (1, [1, 2]),
+    ),
+    (
+        "SELECT source, destination, from_to FROM restrictions WHERE guild=$1",
+        (1,),
+    ),
+    (
+        "SELECT permission FROM custom_permissions WHERE guild = $1 AND command = $2",
+        (1, "command"),
+    ),
+    (
+        "SELECT SUM(uses), MIN(first_used) FROM command_usage_guild_daily WHERE guild=$1",
+        (1,),
+    ),
+    (
+        "SELECT command, SUM(uses) as uses FROM command_usage_author_daily WHERE author = $1 "
+        "GROUP BY command ORDER BY uses DESC LIMIT 5",
+        (1,),
+    ),
+    (
+        "SELECT id, battle_rating FROM users WHERE id = any($1::bigint[]) "
+        "ORDER BY battle_rating DESC",
+        ([1, 2],),
+    ),
+    (
+        "SELECT id, rank, battle_rating, battle_wins, battle_losses FROM "
+        '(SELECT id, ROW_NUMBER () OVER (ORDER BY battle_rating DESC) as "rank", '
+        "battle_rating, battle_wins, battle_losses FROM users "
+        "WHERE id = any($1::bigint[]) AND battle_rating IS NOT NULL) AS sub WHERE id = $2",
+        ([1, 2], 1),
+    ),
+    ("SELECT birthday FROM users WHERE id=$1", (1,)),
+    (
+        "SELECT id, birthday FROM users WHERE id=ANY($1::bigint[]) "
+        "AND birthday = CURRENT_DATE ORDER BY birthday",
+        ([1, 2],),
+    ),
+    (
+        "SELECT id, COALESCE(birthday_alerts, default_alerts) AS channel FROM guilds "
+        "WHERE birthday_notifications=True AND COALESCE(birthday_alerts, default_alerts) IS NOT NULL",
+        (),
+    ),
+    (
+        "SELECT id, followed_picarto_channels, COALESCE(picarto_alerts, default_alerts) AS channel "
+        "FROM guilds WHERE COALESCE(picarto_alerts, default_alerts) IS NOT NULL",
+        (),
+    ),
+    ("SELECT id, osu FROM users WHERE osu IS NOT NULL", ()),
+    ("SELECT * FROM guilds WHERE id = $1", (1,)),
+]
+
+
+async def _ensure_table(connection):
+    await connection.execute(
+        """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    description text,
+    applied timestamp
+)
+"""
+    )
+
+
+async def pending(connection):
+    """Returns the migrations that haven't been applied yet"""
+    await _ensure_table(connection)
+    applied = {
+        row["version"]
+        for row in await connection.fetch("SELECT version FROM schema_migrations")
+    }
+    return [m for m in migrations if m.version not in applied]
+
+
+async def apply(connection):
+    """Applies any pending migrations, each in its own transaction, returning the ones applied"""
+    await connection.execute("SELECT pg_advisory_lock($1)", advisory_lock)
+    try:
+        # Check after taking the lock, someone else may have just applied them
+        to_apply = await pending(connection)
+        for migration in to_apply:
+            log.info(
+                "Applying migration {}: {}".format(
+                    migration.version, migration.description
+                )
+            )
+            async with connection.transaction():
+                await connection.execute(migration.sql)
+                await connection.execute(
+                    "INSERT INTO schema_migrations (version, description, applied) VALUES ($1, $2, $3)",
+                    migration.version,
+                    migration.description,
+                    datetime.datetime.utcnow(),
+                )
+        return to_apply
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", advisory_lock)
+
+
+def _seq_scans(plan):
+    """Yields the relations a plan (from EXPLAIN (FORMAT JSON)) scans sequentially"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+async def check_seq_scans(connection, queries=None):
+    """Returns (query, tables) for each query that would still sequentially scan a table
+
+    Sequential scans are disabled while checking, so that the tiny tables of a local database
+    don't make the planner skip indexes it would use in production. If one still shows up,
+    there's no index it can use"""
+    results = []
+    async with connection.transaction():
+        await connection.execute("SET LOCAL enable_seqscan = off")
+        for query, args in queries or checked_queries:
+            plan = await connection.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            # asyncpg hands json back as a string, unless a codec has been set up for it
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            tables = sorted(set(_seq_scans(plan[0]["Plan"])))
+            if tables:
+                results.append((query, tables))
+    return results
+
+
+async def _main(check):
+    import asyncpg
+
+    connection = await asyncpg.connect(**config.db_opts)
+    try:
+        applied = await apply(connection)
+        print(f"Applied {len(applied)} migration(s)")
+        for migration in applied:
+            print(f"    {migration.version}: {migration.description}")
+
+        if check:
+            flagged = await check_seq_scans(connection)
+            for query, tables in flagged:
+                print(f"Sequential scan on {', '.join(tables)}: {query}")
+            if not flagged:
+                print("No sequential scans found")
+            return 1 if flagged else 0
+        return 0
+    finally:
+        await connection.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Applies any pending database migrations")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Afterwards, check that every known query can avoid a sequential scan",
+    )
+    args = parser.parse_args()
+    raise SystemExit(asyncio.get_event_loop().run_until_complete(_main(args.check)))
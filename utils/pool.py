@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+
+from . import config
+from .metrics import Histogram, timings
+
+log = logging.getLogger()
+
+
+class PoolSample:
+    __slots__ = ("time", "size", "in_use", "idle", "queued", "limit")
+
+    def __init__(self, size, in_use, idle, queued, limit):
+        self.time = time.time()
+        # Connections the pool actually has open
+        self.size = size
+        self.in_use = in_use
+        self.idle = idle
+        # Queries waiting for a connection
+        self.queued = queued
+        # How many connections we're currently allowing to be used at once
+        self.limit = limit
+
+
+class PoolController:
+    """Decides who gets a database connection, so background work can't take every connection from commands
+
+    In adaptive mode the number of connections allowed starts at the minimum, grows while queries are
+    sustainably waiting, and shrinks back when it's mostly idle. The pool then follows it, as idle
+    connections over the minimum are closed by asyncpg"""
+
+    # Samples in a row that had queries waiting before we allow another connection
+    grow_after = 3
+    # Samples in a row using under half of the allowed connections before we allow one less
+    shrink_after = 12
+    # How many samples to keep around for the pool command
+    history = 60
+
+    def __init__(self, *, min_size=None, max_size=None, adaptive=None, reserved=None):
+        self.min_size = min_size or config.db_pool_min_size
+        self.max_size = max_size or config.db_pool_max_size
+        self.adaptive = adaptive if adaptive is not None else config.db_pool_adaptive
+        # Connections background work can never use, so commands can always get one quickly
+        self.reserved = reserved if reserved is not None else config.db_pool_reserved
+        self.limit = self.min_size if self.adaptive else self.max_size
+        self.in_use = 0
+        self.background_in_use = 0
+        self.wait = Histogram()
+        self.samples = deque(maxlen=self.history)
+        self._waiters = deque()
+        self._background_waiters = deque()
+        self._busy = 0
+        self._idle = 0
+        self._task = None
+
+    @property
+    def queued(self):
+        return len(self._waiters) + len(self._background_waiters)
+
+    @staticmethod
+    def is_background():
+        # Anything not ran from a command, such as usage logging or tasks.loop checks
+        return timings.command.get() is None
+
+    def _can_take(self, background):
+        if self.in_use >= self.limit:
+            return False
+        return not background or self.background_in_use < max(
+            1, self.limit - self.reserved
+        )
+
+    def _take(self, background):
+        self.in_use += 1
+        if background:
+            self.background_in_use += 1
+
+    def _wake(self):
+        for background, waiters in (
+            (False, self._waiters),
+            (True, self._background_waiters),
+        ):
+            while waiters and self._can_take(background):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self._take(background)
+                future.set_result(None)
+
+    async def acquire(self, background):
+        start = time.perf_counter()
+        # Background work never skips ahead of anything queued, commands only wait behind other commands
+        ahead = self.queued if background else len(self._waiters)
+        if not ahead and self._can_take(background):
+            self._take(background)
+        else:
+            future = asyncio.get_event_loop().create_future()
+            waiters = self._background_waiters if background else self._waiters
+            waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # We were handed a connection just as we were cancelled, so pass it on
+                    self.release(background)
+                else:
+                    try:
+                        waiters.remove(future)
+                    except ValueError:
+                        pass
+                raise
+        self.wait.record(time.perf_counter() - start)
+
+    def release(self, background):
+        self.in_use -= 1
+        if background:
+            self.background_in_use -= 1
+        self._wake()
+
+    def slot(self):
+        """A context manager holding one of the allowed connections for as long as it's entered"""
+        return _Slot(self)
+
+    def sample(self, pool):
+        sample = PoolSample(
+            pool.get_size(), self.in_use, pool.get_idle_size(), self.queued, self.limit
+        )
+        self.samples.append(sample)
+
+        self._busy = self._busy + 1 if sample.queued else 0
+        if not sample.queued and self.in_use <= self.limit // 2:
+            self._idle += 1
+        else:
+            self._idle = 0
+
+        if not self.adaptive:
+            return sample
+        if self._busy >= self.grow_after and self.limit < self.max_size:
+            self.limit += 1
+            self._busy = 0
+            log.info(
+                "Database pool is busy, now allowing {} connections".format(self.limit)
+            )
+            self._wake()
+        elif self._idle >= self.shrink_after and self.limit > self.min_size:
+            self.limit -= 1
+            self._idle = 0
+            log.info(
+                "Database pool is idle, now allowing {} connections".format(self.limit)
+            )
+        return sample
+
+    def start(self, pool):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._sample_loop(pool))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample_loop(self, pool):
+        while True:
+            await asyncio.sleep(config.db_pool_sample_interval)
+            self.sample(pool)
+
+
+class _Slot:
+    __slots__ = ("controller", "background")
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.background = controller.is_background()
+
+    async def __aenter__(self):
+        await self.controller.acquire(self.background)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.controller.release(self.background)
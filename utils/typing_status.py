@@ -0,0 +1,28 @@
+import asyncio
+
+import discord
+
+from . import config
+from .metrics import timings as default_timings
+
+
+def typing_delay(command, timings=default_timings):
+    """How long to wait before typing for this command, commands that are usually slow start right away"""
+    histogram = timings.histograms.get((command, "total"))
+    if (
+        histogram is not None
+        and histogram.count >= config.typing_min_samples
+        and histogram.percentile(90) > config.typing_threshold
+    ):
+        return 0
+    return config.typing_threshold
+
+
+async def delayed_typing(ctx, delay, timings=default_timings):
+    await asyncio.sleep(delay)
+    with timings.timer("typing"):
+        try:
+            await ctx.trigger_typing()
+        except (discord.Forbidden, discord.HTTPException):
+            pass
+
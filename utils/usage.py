@@ -0,0 +1,266 @@
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import re
+
+from collections import deque
+
+from . import config
+
+log = logging.getLogger()
+
+
+class UsageRecorder:
+    """Queues command_usage rows in memory and writes them to the database in batches"""
+
+    columns = ("command", "guild", "author", "executed")
+
+    def __init__(self, db, *, flush_interval=None, flush_size=None, max_queue=None):
+        self.db = db
+        # The interval is configured in milliseconds, but we sleep in seconds
+        self.flush_interval = (flush_interval or config.usage_flush_interval) / 1000
+        self.flush_size = flush_size or config.usage_flush_size
+        self.max_queue = max_queue or config.usage_max_queue
+        self.queue = deque()
+        # Rows queued, written and thrown away since startup, for the usage command
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def record(self, command, guild, author):
+        """Queues a row to be inserted, this never waits on the database"""
+        # If we're full then the database can't keep up, drop the row instead of growing forever
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        self.queue.append((command, guild, author, datetime.datetime.utcnow()))
+        self.queued += 1
+        # If we've hit our batch size, don't wait for the interval
+        if len(self.queue) >= self.flush_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the background flushing, and writes whatever is left in the queue"""
+        if self._task is not None:
+            # Let a flush that's already writing finish first, cancelling it would lose the batch it took
+            async with self._lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self.queue:
+            if not await self.flush():
+                break
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Keep flushing as long as there's a full batch waiting
+            while self.queue:
+                if not await self.flush() or len(self.queue) < self.flush_size:
+                    break
+
+    async def flush(self):
+        """Writes one batch of rows to the database, returns False if nothing could be written"""
+        # The pool isn't created until the cache has set the database up
+        if self.db._pool is None:
+            return False
+
+        async with self._lock:
+            batch = []
+            while self.queue and len(batch) < self.flush_size:
+                batch.append(self.queue.popleft())
+            if not batch:
+                return False
+
+            try:
+                await self.db.copy_records_to_table(
+                    "command_usage", records=batch, columns=self.columns
+                )
+            except Exception as error:
+                # Don't requeue, if the database is erroring we'd only fill up and drop later anyway
+                self.dropped += len(batch)
+                log.warning(
+                    "Dropped {} command_usage rows: {}: {}".format(
+                        len(batch), error.__class__.__name__, error
+                    )
+                )
+                return False
+            else:
+                self.flushed += len(batch)
+                return True
+
+    @property
+    def pending(self):
+        return len(self.queue)
+
+
+# Rolls up one chunk of command_usage from before the trigger was added, and records how far we've gotten
+# This is all one statement, so the rollups and the progress can't get out of sync if we're interrupted
+_backfill_query = """
+WITH guild_rollup AS (
+    INSERT INTO command_usage_guild_daily (guild, command, day, uses, first_used)
+    SELECT guild, command, executed::date, COUNT(*), MIN(executed)
+    FROM command_usage
+    WHERE guild IS NOT NULL AND executed >= $1 AND executed < $2
+    GROUP BY guild, command, executed::date
+    ON CONFLICT (guild, command, day) DO UPDATE SET
+        uses = command_usage_guild_daily.uses + EXCLUDED.uses,
+        first_used = LEAST(command_usage_guild_daily.first_used, EXCLUDED.first_used)
+), author_rollup AS (
+    INSERT INTO command_usage_author_daily (author, command, day, uses, first_used)
+    SELECT author, command, executed::date, COUNT(*), MIN(executed)
+    FROM command_usage
+    WHERE executed >= $1 AND executed < $2
+    GROUP BY author, command, executed::date
+    ON CONFLICT (author, command, day) DO UPDATE SET
+        uses = command_usage_author_daily.uses + EXCLUDED.uses,
+        first_used = LEAST(command_usage_author_daily.first_used, EXCLUDED.first_used)
+)
+UPDATE command_usage_rollup_state SET backfilled_to = $2
+"""
+
+
+async def backfill_rollups(db, *, chunk=datetime.timedelta(days=1)):
+    """Rolls up the command_usage that was logged before the rollups existed, a chunk at a time
+
+    Progress is saved with each chunk, so this can be stopped at any point and will carry on where it left off"""
+    state = await db.fetchrow(
+        "SELECT backfill_until, backfilled_to FROM command_usage_rollup_state"
+    )
+    if state is None:
+        return
+    until = state["backfill_until"]
+    start = state["backfilled_to"]
+    if start is None:
+        start = await db.fetchval(
+            "SELECT MIN(executed) FROM command_usage WHERE executed < $1", until
+        )
+        # Nothing was logged before the rollups, so there's nothing to do
+        if start is None:
+            await db.execute(
+                "UPDATE command_usage_rollup_state SET backfilled_to = $1", until
+            )
+            return
+
+    if start >= until:
+        return
+    log.info("Backfilling command usage rollups from {} to {}".format(start, until))
+    while start < until:
+        end = min(start + chunk, until)
+        await db.execute(_backfill_query, start, end)
+        start = end
+        # This is only catching up, so leave the database to everything else for a moment
+        await asyncio.sleep(1)
+    log.info("Finished backfilling command usage rollups")
+
+
+_partitions_query = """
+SELECT
+    child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+FROM
+    pg_inherits
+JOIN
+    pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE
+    pg_inherits.inhparent = 'command_usage'::regclass
+"""
+# Such as FOR VALUES FROM ('2020-01-01 00:00:00') TO ('2020-02-01 00:00:00'), or FROM (MINVALUE)
+_bound = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _parse_bound(value):
+    if value == "MINVALUE":
+        return None
+    return datetime.datetime.fromisoformat(value.strip("'"))
+
+
+def _add_months(date, months):
+    years, month = divmod(date.month - 1 + months, 12)
+    return date.replace(year=date.year + years, month=month + 1, day=1)
+
+
+async def usage_partitions(db):
+    """Returns (name, start, end) for each partition of command_usage, start is None for the oldest"""
+    partitions = []
+    for row in await db.fetch(_partitions_query):
+        start, end = _bound.search(row["bound"]).groups()
+        partitions.append((row["name"], _parse_bound(start), _parse_bound(end)))
+    return sorted(partitions, key=lambda p: p[2])
+
+
+async def create_partitions(db, *, ahead=None):
+    """Makes sure there's a partition for this month, and the next few"""
+    ahead = ahead if ahead is not None else config.usage_partitions_ahead
+    partitions = await usage_partitions(db)
+    covered_until = partitions[-1][2] if partitions else None
+
+    this_month = datetime.datetime.utcnow().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    for months in range(ahead + 1):
+        start = _add_months(this_month, months)
+        if covered_until is not None and start < covered_until:
+            continue
+        end = _add_months(start, 1)
+        name = f"command_usage_{start:%Y_%m}"
+        await db.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF command_usage "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+        log.info("Created command_usage partition {}".format(name))
+
+
+async def archive_partition(db, name, directory):
+    """Writes the partition out to a gzipped csv, returning the path"""
+    loop = asyncio.get_event_loop()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.csv.gz")
+    # Only put it in place once it's complete, so a half written archive is never mistaken for a full one
+    with gzip.open(path + ".partial", "wb") as f:
+
+        async def write(chunk):
+            await loop.run_in_executor(None, f.write, chunk)
+
+        await db.copy_from_table(name, output=write, format="csv", header=True)
+    os.replace(path + ".partial", path)
+    return path
+
+
+async def expire_partitions(db, *, retention=None, archive_dir=None):
+    """Drops the partitions older than the retention period, archiving them first if there's somewhere to"""
+    retention = retention if retention is not None else config.usage_retention_months
+    archive_dir = archive_dir or config.usage_archive_dir
+    if not retention:
+        return
+
+    this_month = datetime.datetime.utcnow().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    cutoff = _add_months(this_month, -retention)
+    for name, start, end in await usage_partitions(db):
+        if end > cutoff:
+            continue
+        if archive_dir:
+            path = await archive_partition(db, name, archive_dir)
+            log.info("Archived command_usage partition {} to {}".format(name, path))
+        await db.execute(
+            f"ALTER TABLE command_usage DETACH PARTITION {name}; DROP TABLE {name};"
+        )
+        log.info("Dropped command_usage partition {}".format(name))
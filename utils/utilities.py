@@ -1,26 +1,67 @@
 import aiohttp
-from io import BytesIO
+import asyncio
 import inspect
+import time
 import discord
 import traceback
 from discord.ext import commands
+from tempfile import SpooledTemporaryFile
 
 from . import config
+from .metrics import timings
+from .http_client import http, parse_retry_after
 
 
 def channel_is_nsfw(channel):
     return isinstance(channel, discord.DMChannel) or channel.is_nsfw()
 
 
-async def download_image(url):
-    """Returns a file-like object based on the URL provided"""
-    # Simply read the image, to get the bytes
-    bts = await request(url, attr="read")
-    if bts is None:
+async def download_image(url, *, max_size=None, content_types=None):
+    """Returns a file-like object based on the URL provided, or None if it couldn't be downloaded
+
+    The image is read a chunk at a time, and only kept in memory while it's small. Anything over max_size,
+    or that isn't one of the allowed content types, is given up on as soon as we know"""
+    max_size = max_size or config.image_max_size
+    content_types = content_types or config.image_content_types
+    breaker = http.breaker(url)
+    if not breaker.allow():
         return None
 
-    # Then wrap it in a BytesIO object, to be used like an actual file
-    image = BytesIO(bts)
+    image = None
+    with timings.timer("http"):
+        try:
+            async with http.session.get(
+                url,
+                headers={"User-Agent": config.user_agent},
+                timeout=aiohttp.ClientTimeout(total=http.policy(url).deadline),
+            ) as response:
+                if response.status >= 500:
+                    breaker.failure()
+                    return None
+                breaker.success()
+                if response.status != 200 or response.content_type not in content_types:
+                    return None
+                # If it tells us it's too big, there's no need to download any of it
+                if (response.content_length or 0) > max_size:
+                    return None
+
+                image = SpooledTemporaryFile(max_size=config.image_spool_threshold)
+                size = 0
+                async for chunk in response.content.iter_chunked(65536):
+                    size += len(chunk)
+                    # Content-Length can be missing, or wrong
+                    if size > max_size:
+                        image.close()
+                        return None
+                    image.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.failure()
+            if image is not None:
+                image.close()
+            return None
+
+    # Seek back to the start, so it can be read like it was just opened
+    image.seek(0)
     return image
 
 
@@ -33,6 +74,8 @@ async def request(
     method="GET",
     attr="json",
     force_content_type_json=False,
+    retry=None,
+    coalesce=True,
 ):
     # Make sure our User Agent is what's set, and ensure it's sent even if no headers are passed
     if headers is None:
@@ -40,45 +83,127 @@ async def request(
 
     headers["User-Agent"] = config.user_agent
 
-    # Try 5 times
-    for i in range(5):
-        try:
-            # Create the session with our headeres
-            async with aiohttp.ClientSession(headers=headers) as session:
+    cache_key = http.cache.key(method, url, payload, json_data, attr, headers)
+    cache_ttl = http.cache.ttl(url, attr)
+    if cache_ttl:
+        found, value = await http.cache.get(cache_key)
+        if found:
+            return value
+
+    policy = retry or http.policy(url)
+
+    def fetch():
+        return _fetch(
+            url,
+            headers,
+            payload,
+            json_data,
+            method,
+            attr,
+            force_content_type_json,
+            policy,
+            cache_key if cache_ttl else None,
+            cache_ttl,
+        )
+
+    try:
+        # Only GETs are safe to share, and endpoints that return something random each time pass coalesce=False
+        if method != "GET" or not coalesce:
+            return await asyncio.wait_for(fetch(), policy.deadline)
+        # Anyone else making the exact same request right now shares this one's response
+        return await http.flights.run(
+            (cache_key, force_content_type_json), fetch, policy.deadline
+        )
+    except asyncio.TimeoutError:
+        return None
+
+
+async def _fetch(
+    url,
+    headers,
+    payload,
+    json_data,
+    method,
+    attr,
+    force_content_type_json,
+    policy,
+    cache_key,
+    cache_ttl,
+):
+    breaker = http.breaker(url)
+    deadline = time.monotonic() + policy.deadline
+
+    with timings.timer("http"):
+        for attempt in range(policy.attempts):
+            # If the site is down don't add to its load, or make whoever ran the command wait on it
+            if not breaker.allow():
+                return None
+
+            retry_after = None
+            try:
                 # Make the request, based on the method, url, and paramaters given
-                async with session.request(
-                    method, url, params=payload, json=json_data
+                async with http.session.request(
+                    method,
+                    url,
+                    params=payload,
+                    json=json_data,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=deadline - time.monotonic()),
                 ) as response:
-                    # If the request wasn't successful, re-attempt
-                    if response.status != 200:
-                        continue
-
-                    try:
-                        # Get the attribute requested
-                        return_value = getattr(response, attr)
-                        # Next check if this can be called
-                        if callable(return_value):
-                            # This is use for json; it checks the mimetype instead of checking if the actual data
-                            # This causes some places with different mimetypes to fail, even if it's valid json
-                            # This check allows us to force the content_type to use whatever content type is given
-                            if force_content_type_json:
-                                return_value = return_value(
-                                    content_type=response.headers["content-type"]
-                                )
-                            else:
-                                return_value = return_value()
-                        # If this is awaitable, await it
-                        if inspect.isawaitable(return_value):
-                            return_value = await return_value
-
-                        # Then return it
-                        return return_value
-                    except AttributeError:
-                        # If an invalid attribute was requested, return None
-                        return None
-        # If an error was hit other than the one we want to catch, try again
-        except Exception:
-            continue
+                    if response.status in policy.statuses:
+                        breaker.failure()
+                        retry_after = parse_retry_after(
+                            response.headers.get("Retry-After")
+                        )
+                    else:
+                        # Anything else means the site is up, even if we asked for something it doesn't have
+                        breaker.success()
+                        value = None
+                        if response.status == 200:
+                            value = await _read_response(
+                                response, attr, force_content_type_json
+                            )
+                        # Only remember what the site actually told us, not what we failed to read
+                        if cache_key is not None and (
+                            value is not None or response.status in (404, 410)
+                        ):
+                            http.cache.set(cache_key, value, attr, cache_ttl)
+                        return value
+            # A connection error or timeout, worth trying again
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.failure()
+
+            # Don't bother waiting if we'd be past the deadline by the time we tried again
+            delay = policy.delay(attempt, retry_after)
+            if attempt + 1 == policy.attempts or time.monotonic() + delay >= deadline:
+                return None
+            await asyncio.sleep(delay)
+
+
+async def _read_response(response, attr, force_content_type_json):
+    try:
+        # Get the attribute requested
+        return_value = getattr(response, attr)
+        # Next check if this can be called
+        if callable(return_value):
+            # This is use for json; it checks the mimetype instead of checking if the actual data
+            # This causes some places with different mimetypes to fail, even if it's valid json
+            # This check allows us to force the content_type to use whatever content type is given
+            if force_content_type_json:
+                return_value = return_value(
+                    content_type=response.headers["content-type"]
+                )
+            else:
+                return_value = return_value()
+        # If this is awaitable, await it
+        if inspect.isawaitable(return_value):
+            return_value = await return_value
+
+        # Then return it
+        return return_value
+    # If an invalid attribute was requested, or the body wasn't what was expected, return None
+    except (AttributeError, ValueError, aiohttp.ClientError, asyncio.TimeoutError):
+        return None
 
 
 async def log_error(error, bot, ctx=None):
@@ -153,8 +278,6 @@ async def update_records(key, db, winner, loser):
     wins = f"{key}_wins"
     losses = f"{key}_losses"
     key = f"{key}_rating"
-    winner_found = False
-    loser_found = False
     query = (
         f"SELECT id, {key}, {wins}, {losses} FROM users WHERE id = any($1::bigint[])"
     )
@@ -166,12 +289,10 @@ async def update_records(key, db, winner, loser):
     winner_losses = loser_losses = 0
     for result in results:
         if result["id"] == winner.id:
-            winner_found = True
             winner_rating = result[key]
             winner_wins = result[wins]
             winner_losses = result[losses]
         else:
-            loser_found = True
             loser_rating = result[key]
             loser_wins = result[wins]
             loser_losses = result[losses]
@@ -200,22 +321,25 @@ async def update_records(key, db, winner, loser):
     winner_wins += 1
     loser_losses += 1
 
-    update_query = f"UPDATE users SET {key}=$1, {wins}=$2, {losses}=$3 WHERE id = $4"
-    create_query = (
-        f"INSERT INTO users ({key}, {wins}, {losses}, id) VALUES ($1, $2, $3, $4)"
+    # Both rows are upserted together in one transaction, whether or not either user has a row yet
+    await db.upsert(
+        "users",
+        [
+            {
+                "id": winner.id,
+                key: winner_rating,
+                wins: winner_wins,
+                losses: winner_losses,
+            },
+            {
+                "id": loser.id,
+                key: loser_rating,
+                wins: loser_wins,
+                losses: loser_losses,
+            },
+        ],
+        ["id"],
     )
-    if winner_found:
-        await db.execute(
-            update_query, winner_rating, winner_wins, winner_losses, winner.id
-        )
-    else:
-        await db.execute(
-            create_query, winner_rating, winner_wins, winner_losses, winner.id
-        )
-    if loser_found:
-        await db.execute(update_query, loser_rating, loser_wins, loser_losses, loser.id)
-    else:
-        await db.execute(create_query, loser_rating, loser_wins, loser_losses, loser.id)
 
 
 def chunks(list, n):